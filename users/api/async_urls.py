@@ -0,0 +1,12 @@
+from django.urls import path
+from .async_views import (user_list, contact_detail, email_detail,
+                          number_detail)
+
+urlpatterns = [
+    path('users/', user_list, name='async-user'),
+    path('users/<int:id>/contact/', contact_detail, name='async-contact'),
+    path('users/<int:id>/contact/email/<int:pk>', email_detail,
+         name='async-email'),
+    path('users/<int:id>/contact/phone-number/<int:pk>', number_detail,
+         name='async-number'),
+]
@@ -0,0 +1,96 @@
+"""
+Async counterparts of the read endpoints, for ASGI deployments.
+
+DRF views are synchronous, so these are plain Django async views returning
+the same payloads. ORM work runs through `run_db`, which hands it to
+`sync_to_async` and lets at most ASYNC_DB_POOL_SIZE calls (and so database
+connections) run at once per event loop.
+"""
+import asyncio
+import functools
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponseNotAllowed, HttpResponseNotFound
+from django.http import JsonResponse
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+
+from .pagination import KeysetPagination
+from .serializers import requested_fields, serialize_user_rows, user_rows
+from .views import UserView, user_contact_detail, user_detail
+
+_pools = weakref.WeakKeyDictionary()
+
+
+async def run_db(func, *args):
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = asyncio.Semaphore(settings.ASYNC_DB_POOL_SIZE)
+    async with pool:
+        return await sync_to_async(func)(*args)
+
+
+def require_get(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return HttpResponseNotAllowed(['GET', 'HEAD'])
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def _list_users(request):
+    request = Request(request)
+    view = UserView(request=request)
+    qs = view.filter_queryset(view.get_queryset())
+    fields = requested_fields(request.query_params)
+    paginator = KeysetPagination()
+    page = paginator.paginate_queryset(user_rows(qs, fields), request)
+    if page is None:
+        return serialize_user_rows(list(user_rows(qs, fields)),
+                                   user_ids=qs.values('id'), fields=fields)
+    return paginator.get_paginated_response(
+        serialize_user_rows(page, fields=fields)).data
+
+
+@require_get
+async def user_list(request):
+    try:
+        payload = await run_db(_list_users, request)
+    except ValidationError as exc:
+        return JsonResponse(exc.detail, status=400, safe=False)
+    return JsonResponse(payload, safe=False)
+
+
+@require_get
+async def contact_detail(request, id):
+    try:
+        fields = requested_fields(request.GET)
+    except ValidationError as exc:
+        return JsonResponse(exc.detail, status=400, safe=False)
+    payload = await run_db(user_detail, id)
+    if payload is None:
+        return HttpResponseNotFound()
+    # the whole payload is cached, `fields` only trims the response
+    return JsonResponse({key: value for key, value in payload.items()
+                         if key in fields})
+
+
+@require_get
+async def email_detail(request, id, pk):
+    contact = await run_db(user_contact_detail, id, "emails", "email", pk)
+    if contact is None:
+        return HttpResponseNotFound()
+    return JsonResponse({"email": contact[0]})
+
+
+@require_get
+async def number_detail(request, id, pk):
+    contact = await run_db(user_contact_detail, id, "phonenumbers", "number",
+                           pk)
+    if contact is None:
+        return HttpResponseNotFound()
+    return JsonResponse({"number": contact[0]})
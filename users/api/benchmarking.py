@@ -0,0 +1,52 @@
+def percentile(values, q):
+    """The `q`-th percentile (0-100) of the already sorted `values`."""
+    if not values:
+        return 0.0
+    rank = int(round(q / 100 * len(values)))
+    return values[min(len(values) - 1, max(0, rank - 1))]
+
+
+def summarize(latencies, elapsed):
+    """Throughput and latency percentiles (ms) of timed requests."""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+class CommitCounter:
+    """
+    Counts the transactions that write, hence flush to disk, while active
+    on `connection`: each write statement run in autocommit mode, and each
+    transaction of an atomic block that writes.
+    """
+    WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commits = 0
+        # registered with on_commit() at the first write of a transaction;
+        # the connection drops its commit hooks when the transaction ends
+        self._marker = lambda: None
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip()[:6].upper() in self.WRITES:
+            if not self.connection.in_atomic_block:
+                self.commits += 1
+            elif not any(func is self._marker
+                         for _, func in self.connection.run_on_commit):
+                self.connection.on_commit(self._marker)
+                self.commits += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
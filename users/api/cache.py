@@ -0,0 +1,112 @@
+"""
+Read-through cache of the per-user detail payload (the output of
+`DetailedUserSerializer`), keyed by user id.
+
+Every write path calls `invalidate_users` with the ids it touched; once the
+surrounding transaction commits, each of these users gets a new generation.
+Payloads are cached with the generation read before they were loaded and
+only served while it is still the user's current one, so a reader that
+loaded the pre-commit state and stores it after the invalidation caches
+nothing anyone will read.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+KEY = 'api:user:%d'
+GENERATION_KEY = 'api:user:%d:generation'
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _cache():
+    return caches[settings.USER_CACHE_ALIAS]
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _read(cache, user_ids):
+    """
+    The payloads of `user_ids` cached for their current generation, and
+    these generations (`None` for a user never written), in one round trip.
+    """
+    found = cache.get_many([KEY % user_id for user_id in user_ids] +
+                           [GENERATION_KEY % user_id for user_id in user_ids])
+    generations = {user_id: found.get(GENERATION_KEY % user_id)
+                   for user_id in user_ids}
+    payloads = {}
+    for user_id in user_ids:
+        entry = found.get(KEY % user_id)
+        if entry is not None and entry[0] == generations[user_id]:
+            payloads[user_id] = entry[1]
+    return payloads, generations
+
+
+def _store(cache, payloads, generations):
+    cache.set_many({KEY % user_id: (generations[user_id], payload)
+                    for user_id, payload in payloads.items()},
+                   settings.USER_CACHE_TIMEOUT)
+
+
+def get_user_detail(user_id, load):
+    """
+    Return the cached payload for `user_id`, calling `load()` to build and
+    cache it on a miss. A `None` result (unknown user) is not cached.
+    """
+    cache = _cache()
+    payloads, generations = _read(cache, [user_id])
+    if user_id in payloads:
+        _count('hits')
+        return payloads[user_id]
+    _count('misses')
+    payload = load()
+    if payload is not None:
+        _store(cache, {user_id: payload}, generations)
+    return payload
+
+
+def get_user_details(user_ids, load):
+    """
+    The payloads of `user_ids` as a dict, read from the cache in one round
+    trip and built for the misses with `load(missing_ids)`, which returns a
+    dict of the known ones; those are then cached in turn.
+    """
+    cache = _cache()
+    payloads, generations = _read(cache, user_ids)
+    with _stats_lock:
+        _stats['hits'] += len(payloads)
+        _stats['misses'] += len(user_ids) - len(payloads)
+    missing = [user_id for user_id in user_ids if user_id not in payloads]
+    if missing:
+        loaded = load(missing)
+        _store(cache, loaded, generations)
+        payloads.update(loaded)
+    return payloads
+
+
+def peek_user_detail(user_id):
+    """The cached payload for `user_id`, `None` on a miss (not loaded)."""
+    payload = _read(_cache(), [user_id])[0].get(user_id)
+    _count('misses' if payload is None else 'hits')
+    return payload
+
+
+def invalidate_users(user_ids):
+    # generations do not expire, a payload cached for an older one must
+    # never become current again
+    keys = [GENERATION_KEY % user_id for user_id in user_ids]
+    if keys:
+        transaction.on_commit(lambda: _cache().set_many(
+            {key: uuid.uuid4().hex for key in keys}, None))
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,75 @@
+"""
+Conditional GET for the user resources. The validators (ETag, and
+Last-Modified for single users) are derived from `User.updated_at`: read
+along with the data for a single user (from the cache on a hit) and with
+one aggregate query for listings, so a client holding the current
+representation gets a 304 before any contact is loaded or anything is
+rendered.
+"""
+from django.db.models import BigIntegerField, Count, Func, Max, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+
+
+def _micros(value):
+    return int(value.timestamp() * 1000000) if value is not None else 0
+
+
+def user_etag(user_id, updated_at):
+    return quote_etag('%d-%d' % (user_id, _micros(updated_at)))
+
+
+class _WrappedMicros(Func):
+    """
+    The microseconds of a datetime modulo 2**32, small enough to be summed
+    over any table without overflowing.
+    """
+    output_field = BigIntegerField()
+    template = ('(CAST(EXTRACT(EPOCH FROM %(expressions)s) * 1000000 '
+                'AS bigint) %%%% 4294967296)')
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # stored as text, with the microseconds after the seconds if any
+        return self.as_sql(compiler, connection, template=(
+            "((CAST(strftime('%%%%s', %(expressions)s) AS integer) * 1000000 "
+            "+ CAST(substr(%(expressions)s, 21, 6) AS integer)) "
+            "%%%% 4294967296)"), **extra_context)
+
+
+def users_etag(queryset):
+    """
+    ETag of the users of `queryset`: any write changes the sum of the
+    `updated_at` of the rows, whatever the order writers commit in (where
+    the latest `updated_at` could stay the same); creations and deletions
+    change the count or the highest id.
+    """
+    state = queryset.aggregate(count=Count('id'), last_id=Max('id'),
+                               version=Sum(_WrappedMicros('updated_at')))
+    return quote_etag('%d-%d-%d' % (state['count'], state['last_id'] or 0,
+                                    state['version'] or 0))
+
+
+def conditional_response(request, etag, last_modified, render):
+    """
+    The 304 (or 412) response the request's preconditions call for, or
+    else `render()`; either way with the validators set.
+    """
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified and int(
+            last_modified.timestamp()))
+    if response is None:
+        response = render()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(
+            last_modified.timestamp())
+    return response
+
+
+def conditional_user_response(request, user_id, updated_at, render):
+    """`conditional_response` for a resource of user `user_id`."""
+    return conditional_response(request, user_etag(user_id, updated_at),
+                                updated_at, render)
@@ -0,0 +1,13 @@
+from django.db import connections
+
+
+def check_connection_health(**kwargs):
+    """
+    Drop persistent connections that stopped working (server restart,
+    pooler recycling, ...) before a request gets to use them. Enabled per
+    database with the CONN_HEALTH_CHECKS option.
+    """
+    for conn in connections.all():
+        if (conn.settings_dict.get('CONN_HEALTH_CHECKS') and
+                conn.connection is not None and not conn.is_usable()):
+            conn.close()
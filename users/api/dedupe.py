@@ -0,0 +1,58 @@
+"""
+Merging of contact rows that hold the same value once normalized.
+
+The functions take the model classes to work on, so that they serve both
+the `dedupe_contacts` command and the historical models of migration 0006.
+"""
+
+
+def merge_duplicate_contacts(model, through, value_field, target, normalize,
+                             batch_size=1000):
+    """
+    Normalize `value_field` of every `model` row and merge the rows equal
+    after normalization into the one with the lowest id, moving their links
+    in the `through` table (whose foreign key to `model` is `target`) over.
+
+    Returns the number of merged rows and the ids of the users whose
+    contacts changed.
+    """
+    canonical, duplicates, renamed = {}, {}, []
+    rows = model.objects.order_by('id').values_list('id', value_field)
+    for contact_id, value in rows.iterator(chunk_size=batch_size):
+        key = normalize(value)
+        if key in canonical:
+            duplicates[contact_id] = canonical[key]
+        else:
+            canonical[key] = contact_id
+            if key != value:
+                renamed.append(model(**{'id': contact_id, value_field: key}))
+
+    users = set()
+    duplicate_ids = list(duplicates)
+    for start in range(0, len(duplicate_ids), batch_size):
+        batch = duplicate_ids[start:start + batch_size]
+        links = through.objects.filter(**{target + '_id__in': batch})
+        moved = [through(**{'user_id': user_id,
+                            target + '_id': duplicates[contact_id]})
+                 for user_id, contact_id
+                 in links.values_list('user_id', target + '_id')]
+        links.delete()
+        # users linked to both copies keep a single link
+        through.objects.bulk_create(moved, ignore_conflicts=True)
+        model.objects.filter(id__in=batch).delete()
+        users.update(link.user_id for link in moved)
+
+    # only once the duplicates are gone, as the values are unique
+    model.objects.bulk_update(renamed, [value_field], batch_size=batch_size)
+    renamed_ids = [contact.id for contact in renamed]
+    for start in range(0, len(renamed_ids), batch_size):
+        users.update(through.objects.filter(**{
+            target + '_id__in': renamed_ids[start:start + batch_size],
+        }).values_list('user_id', flat=True))
+    return len(duplicates), users
+
+
+def delete_unreferenced_contacts(model):
+    """Delete the `model` rows no user links to, returning their number."""
+    unreferenced = model.objects.filter(user__isnull=True)
+    return unreferenced._raw_delete(unreferenced.db)
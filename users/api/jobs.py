@@ -0,0 +1,188 @@
+"""
+Background imports and exports, for the batches too large to go through a
+single request. A job is split into partitions stored in the database (a
+slice of the rows to import, a range of user ids to export); the worker
+processes of `manage.py run_jobs` each claim one partition at a time with
+SELECT .. FOR UPDATE SKIP LOCKED and run it in a single transaction, so no
+broker is needed and the partition of a killed worker is rolled back and
+run again once its claim has expired.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max, Min, Q
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .models import Job, JobPartition, User
+from .renderers import dumps
+from .serializers import (CreateUserWithContactInfoSerializer,
+                          serialize_user_rows, user_rows)
+
+
+class ClaimExpired(Exception):
+    """The partition was claimed again by another worker meanwhile."""
+
+
+def submit_import(rows):
+    """A job creating the users of the `rows` payloads."""
+    size = settings.JOB_IMPORT_PARTITION_SIZE
+    return _submit(Job(kind=Job.IMPORT, total=len(rows)), [
+        JobPartition(number=number, start=start, end=start + size,
+                     payload=rows[start:start + size])
+        for number, start in enumerate(range(0, len(rows), size))])
+
+
+def submit_export(filters, fields):
+    """
+    A job writing the users matching the exact-match `filters` as NDJSON
+    lines restricted to `fields`, like `[GET] /api/v1/users/export/`.
+    """
+    size = settings.JOB_EXPORT_PARTITION_SIZE
+    bounds = User.objects.filter(**filters).aggregate(first=Min('id'),
+                                                      last=Max('id'))
+    starts = range(bounds['first'], bounds['last'] + 1, size) \
+        if bounds['first'] is not None else []
+    return _submit(
+        Job(kind=Job.EXPORT, params={'filters': filters,
+                                     'fields': list(fields)}), [
+            JobPartition(number=number, start=start, end=start + size)
+            for number, start in enumerate(starts)])
+
+
+def _submit(job, partitions):
+    job.partitions = len(partitions)
+    if not partitions:
+        job.status, job.finished_at = Job.DONE, timezone.now()
+    with transaction.atomic():
+        job.save()
+        for partition in partitions:
+            partition.job = job
+        JobPartition.objects.bulk_create(partitions, batch_size=100)
+    return job
+
+
+def claim_partition(job_id=None):
+    """
+    Claim the next pending partition (of `job_id` only if given), or one
+    whose claim has expired, `None` when there is none. A partition that
+    has already been claimed JOB_MAX_ATTEMPTS times fails its job.
+    """
+    while True:
+        now = timezone.now()
+        expired = now - timedelta(seconds=settings.JOB_LEASE_SECONDS)
+        with transaction.atomic():
+            partitions = JobPartition.objects.filter(
+                Q(status=Job.PENDING) |
+                Q(status=Job.RUNNING, claimed_at__lt=expired))
+            if job_id is not None:
+                partitions = partitions.filter(job_id=job_id)
+            partition = partitions.select_for_update(
+                skip_locked=True).order_by('id').first()
+            if partition is None:
+                return None
+            if partition.attempts >= settings.JOB_MAX_ATTEMPTS:
+                _fail(partition, 'Worker lost %d times.' % partition.attempts)
+                continue
+            partition.status, partition.claimed_at = Job.RUNNING, now
+            partition.attempts += 1
+            partition.save(update_fields=['status', 'claimed_at',
+                                          'attempts'])
+            Job.objects.filter(id=partition.job_id, status=Job.PENDING).update(
+                status=Job.RUNNING, started_at=now)
+        return partition
+
+
+def run_partition(partition):
+    """
+    Run a claimed partition. Its work and its completion are committed
+    together, so a failure leaves nothing behind; the partition is then
+    retried, up to JOB_MAX_ATTEMPTS times in all.
+    """
+    job = partition.job
+    try:
+        with transaction.atomic():
+            processed, errors, output = RUNNERS[job.kind](job, partition)
+            claimed = JobPartition.objects.filter(
+                id=partition.id, status=Job.RUNNING,
+                claimed_at=partition.claimed_at)
+            if not claimed.update(status=Job.DONE, payload=None,
+                                  output=output, errors=errors, error=''):
+                raise ClaimExpired()
+            Job.objects.filter(id=job.id).update(
+                done_partitions=F('done_partitions') + 1,
+                processed=F('processed') + processed,
+                failed_rows=F('failed_rows') + len(errors))
+            Job.objects.filter(id=job.id, status=Job.RUNNING,
+                               done_partitions=F('partitions')).update(
+                status=Job.DONE, finished_at=timezone.now())
+    except ClaimExpired:
+        return
+    except Exception as exc:
+        with transaction.atomic():
+            if partition.attempts >= settings.JOB_MAX_ATTEMPTS:
+                _fail(partition, repr(exc))
+            else:
+                JobPartition.objects.filter(
+                    id=partition.id, status=Job.RUNNING,
+                    claimed_at=partition.claimed_at).update(
+                    status=Job.PENDING, error=repr(exc))
+
+
+def _fail(partition, error):
+    """Fail `partition`, its job and the job's partitions not run yet."""
+    now = timezone.now()
+    JobPartition.objects.filter(id=partition.id).update(status=Job.FAILED,
+                                                        error=error)
+    JobPartition.objects.filter(job_id=partition.job_id,
+                                status=Job.PENDING).update(status=Job.FAILED)
+    Job.objects.filter(id=partition.job_id).update(
+        status=Job.FAILED, error='Partition %d: %s' % (partition.number,
+                                                       error),
+        finished_at=now)
+
+
+def work(once=False, poll=1.0, job_id=None):
+    """
+    Claim and run partitions, waiting `poll` seconds whenever there is none,
+    or returning then if `once`. Returns the number of partitions run.
+    """
+    ran = 0
+    while True:
+        partition = claim_partition(job_id)
+        if partition is None:
+            if once:
+                return ran
+            time.sleep(poll)
+            continue
+        run_partition(partition)
+        ran += 1
+
+
+def _import(job, partition):
+    # rows are validated one by one, so that an invalid row is reported
+    # without rejecting the rest of the partition
+    user, valid, errors = CreateUserWithContactInfoSerializer(), [], []
+    for offset, row in enumerate(partition.payload, start=partition.start):
+        try:
+            valid.append(user.run_validation(row))
+        except ValidationError as exc:
+            errors.append({"row": offset, "errors": exc.detail})
+    if valid:
+        CreateUserWithContactInfoSerializer(many=True).create(valid)
+    return len(valid), errors, ''
+
+
+def _export(job, partition):
+    fields = tuple(job.params['fields'])
+    rows = list(user_rows(User.objects.filter(
+        id__gte=partition.start, id__lt=partition.end,
+        **job.params['filters']).order_by('id'), fields))
+    return len(rows), [], b''.join(
+        dumps(user) + b'\n'
+        for user in serialize_user_rows(rows, fields=fields)).decode()
+
+
+RUNNERS = {Job.IMPORT: _import, Job.EXPORT: _export}
@@ -0,0 +1,176 @@
+"""
+Bulk loading of users from CSV or NDJSON files, for seeding and data
+migrations. On PostgreSQL each batch is streamed with COPY into temporary
+staging tables and moved into the contact, user, join and change log
+tables with one INSERT .. SELECT each; other databases go through the bulk
+create path of the API.
+
+Rows are shaped like the `[POST] /api/v1/users/` body. They are normalized
+like the API does but not otherwise validated.
+"""
+import csv
+import io
+import json
+from itertools import islice
+
+from django.db import connection, transaction
+
+from .models import User, UserChange
+from .normalization import normalize_email, normalize_phone
+from .serializers import CreateUserWithContactInfoSerializer
+
+FORMATS = ('csv', 'ndjson')
+CSV_COLUMNS = ('lastname', 'firstname', 'emails', 'phonenumbers')
+# separates the values of the emails and phonenumbers CSV columns
+CSV_SEPARATOR = ';'
+
+CONTACT_FIELDS = [
+    ('emails', 'email', normalize_email),
+    ('phonenumbers', 'number', normalize_phone),
+]
+
+
+def file_format(path):
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+
+def read_users(f, fmt):
+    """The user payloads of the CSV or NDJSON file object `f`."""
+    if fmt == 'csv':
+        for record in csv.DictReader(f):
+            yield {'lastname': record['lastname'],
+                   'firstname': record['firstname'],
+                   'emails': record['emails'].split(CSV_SEPARATOR),
+                   'phonenumbers': record['phonenumbers'].split(
+                       CSV_SEPARATOR)}
+        return
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_users(users, f, fmt):
+    """Write the user payloads `users` to the file object `f`."""
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(CSV_COLUMNS)
+        for user in users:
+            writer.writerow([user['lastname'], user['firstname'],
+                             CSV_SEPARATOR.join(user['emails']),
+                             CSV_SEPARATOR.join(user['phonenumbers'])])
+        return
+    for user in users:
+        f.write(json.dumps(user) + '\n')
+
+
+def load_users(users, batch_size=50000):
+    """
+    Insert the user payloads `users` a batch at a time, each batch in its
+    own transaction. Yields the number of users loaded so far.
+    """
+    load = _copy_batch if connection.vendor == 'postgresql' else _orm_batch
+    users, loaded = iter(users), 0
+    while True:
+        batch = [_normalized(user) for user in islice(users, batch_size)]
+        if not batch:
+            return
+        with transaction.atomic():
+            load(batch)
+        loaded += len(batch)
+        yield loaded
+
+
+def _normalized(user):
+    item = {'lastname': user['lastname'], 'firstname': user['firstname']}
+    for field_name, _, normalize in CONTACT_FIELDS:
+        item[field_name] = list(dict.fromkeys(
+            normalize(value) for value in user.get(field_name) or []
+            if value))
+    return item
+
+
+def _orm_batch(batch):
+    CreateUserWithContactInfoSerializer(many=True).create(batch)
+
+
+def _copy_batch(batch):
+    qn = connection.ops.quote_name
+    user_table = qn(User._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS load_user (item bigint, id '
+            'bigint, lastname varchar(255), firstname varchar(255))')
+        for field_name, _, _ in CONTACT_FIELDS:
+            cursor.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS load_%s (item bigint, '
+                'position int, value text)' % field_name)
+        cursor.execute('TRUNCATE load_user, load_emails, load_phonenumbers')
+
+        _copy(cursor, 'load_user (item, lastname, firstname)', [
+            (item, user['lastname'], user['firstname'])
+            for item, user in enumerate(batch)])
+        for field_name, _, _ in CONTACT_FIELDS:
+            _copy(cursor, 'load_%s (item, position, value)' % field_name, [
+                (item, position, value)
+                for item, user in enumerate(batch)
+                for position, value in enumerate(user[field_name])])
+        cursor.execute('ANALYZE load_user, load_emails, load_phonenumbers')
+
+        # ids in the order of the rows, from the table's own sequence
+        cursor.execute(
+            "UPDATE load_user SET id = ids.id FROM (SELECT item, nextval("
+            "pg_get_serial_sequence(%s, 'id')) AS id FROM (SELECT item "
+            "FROM load_user ORDER BY item) items) ids "
+            "WHERE load_user.item = ids.item", [User._meta.db_table])
+
+        joins, pairs = [], []
+        for field_name, value_field, _ in CONTACT_FIELDS:
+            field = User._meta.get_field(field_name)
+            through = field.remote_field.through
+            contact_table = qn(field.related_model._meta.db_table)
+            cursor.execute(
+                'INSERT INTO %s (%s) SELECT DISTINCT value FROM load_%s '
+                'ON CONFLICT (%s) DO NOTHING' % (
+                    contact_table, qn(value_field), field_name,
+                    qn(value_field)))
+            cursor.execute(
+                'INSERT INTO %s (%s, %s) SELECT u.id, c.id FROM load_%s l '
+                'JOIN load_user u ON u.item = l.item JOIN %s c ON c.%s = '
+                'l.value ORDER BY l.item, l.position' % (
+                    qn(through._meta.db_table),
+                    qn(field.m2m_column_name()),
+                    qn(field.m2m_reverse_name()), field_name, contact_table,
+                    qn(value_field)))
+            # the `User.contacts` snapshot, see contact_snapshots()
+            pairs.append(
+                '%s AS (SELECT l.item, jsonb_agg(jsonb_build_array(c.id, '
+                'c.%s) ORDER BY l.position) AS pairs FROM load_%s l JOIN %s '
+                'c ON c.%s = l.value GROUP BY l.item)' % (
+                    field_name, qn(value_field), field_name, contact_table,
+                    qn(value_field)))
+            joins.append('LEFT JOIN %s ON %s.item = u.item'
+                         % (field_name, field_name))
+        cursor.execute(
+            "WITH %s INSERT INTO %s (id, lastname, firstname, contacts, "
+            "updated_at) SELECT u.id, u.lastname, u.firstname, "
+            "jsonb_build_object('emails', COALESCE(emails.pairs, '[]'), "
+            "'phonenumbers', COALESCE(phonenumbers.pairs, '[]')), now() "
+            "FROM load_user u %s ORDER BY u.item" % (
+                ', '.join(pairs), user_table, ' '.join(joins)))
+        # last, see record_changes()
+        cursor.execute(
+            'INSERT INTO %s (user_id, kind, at) SELECT id, %%s, now() FROM '
+            'load_user ORDER BY item' % qn(UserChange._meta.db_table),
+            [UserChange.CREATED])
+
+
+def _copy(cursor, table, rows):
+    """COPY `rows` into `table` in PostgreSQL's text format."""
+    def text(value):
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+            '\n', '\\n').replace('\r', '\\r')
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(text(value) for value in row) + '\n')
+    buffer.seek(0)
+    cursor.copy_expert('COPY %s FROM STDIN' % table, buffer)
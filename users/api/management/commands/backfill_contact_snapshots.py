@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.cache import invalidate_users
+from api.models import (User, UserChange, lock_users, record_changes,
+                        refresh_contact_snapshots)
+
+
+class Command(BaseCommand):
+    help = "Fill the denormalized User.contacts column from the join tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--all', action='store_true',
+                            help='Rewrite every row, not only empty ones.')
+
+    def handle(self, *args, **options):
+        qs = User.objects.order_by('id')
+        if not options['all']:
+            qs = qs.filter(contacts__isnull=True)
+        done, last_id = 0, 0
+        while True:
+            ids = list(qs.filter(id__gt=last_id).values_list(
+                'id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            with transaction.atomic():
+                # contact writes to these users wait, so none is overwritten
+                lock_users(ids)
+                refresh_contact_snapshots(ids)
+                record_changes(ids, UserChange.UPDATED)
+                invalidate_users(ids)
+            done, last_id = done + len(ids), ids[-1]
+            self.stdout.write('%d users backfilled' % done, ending='\r')
+        self.stdout.write(self.style.SUCCESS('%d users backfilled' % done))
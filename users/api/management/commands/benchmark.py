@@ -0,0 +1,288 @@
+import json
+import random
+import time
+import tracemalloc
+from collections import namedtuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from api import urls
+from api.benchmarking import CommitCounter, summarize
+from api.jobs import submit_export, work
+from api.models import User, UserChange, contact_snapshots
+from api.seeding import create_users, fake_user, seed_users
+from api.serializers import USER_FIELDS
+
+Scenario = namedtuple('Scenario', 'label route method build')
+
+# One or more scenarios per route of api/urls.py, run in this order. `build`
+# gets the run state and returns the path and the payload (query parameters
+# for GET) of the next request.
+SCENARIOS = [
+    Scenario('list users page', 'user', 'get', lambda s: (
+        reverse('user'), {'after': s.user()['id'] - 1, 'limit': 100})),
+    Scenario('list users names', 'user', 'get', lambda s: (
+        reverse('user'), {'after': s.user()['id'] - 1, 'limit': 100,
+                          'fields': 'id,lastname,firstname'})),
+    Scenario('filter users', 'user', 'get', lambda s: (
+        reverse('user'), {'firstname': s.user()['firstname'],
+                          'limit': 100})),
+    Scenario('search users', 'user', 'get', lambda s: (
+        reverse('user'), {'q': s.user()['firstname'][:4]})),
+    Scenario('create user', 'user', 'post', lambda s: (
+        reverse('user'), fake_user(s.rng))),
+    Scenario('bulk create', 'bulk', 'post', lambda s: (
+        reverse('bulk'), [fake_user(s.rng) for _ in range(100)])),
+    Scenario('bulk delete', 'bulk', 'delete', lambda s: (
+        reverse('bulk'), {'ids': [s.created_user() for _ in range(10)]})),
+    Scenario('export', 'export', 'get', lambda s: (
+        reverse('export'), {'firstname': s.user()['firstname']})),
+    Scenario('change feed', 'changes', 'get', lambda s: (
+        reverse('changes'), {'after': s.change_cursor, 'limit': 100})),
+    Scenario('batch get', 'batch', 'get', lambda s: (
+        reverse('batch'), {'ids': ','.join(
+            str(s.user()['id']) for _ in range(100))})),
+    Scenario('submit import', 'job-import', 'post', lambda s: (
+        reverse('job-import'), [fake_user(s.rng) for _ in range(100)])),
+    Scenario('submit export', 'job-export', 'post', lambda s: (
+        reverse('job-export') + '?firstname=' + s.user()['firstname'],
+        None)),
+    Scenario('job status', 'job', 'get', lambda s: (
+        reverse('job', kwargs={'id': s.export_job()}), None)),
+    Scenario('job result', 'job-result', 'get', lambda s: (
+        reverse('job-result', kwargs={'id': s.export_job()}), None)),
+    Scenario('lookup', 'lookup', 'get', lambda s: (
+        reverse('lookup'), {'email': s.contact(s.user(), 'emails'),
+                            'phone': s.contact(s.user(), 'phonenumbers')})),
+    Scenario('cache stats', 'cache-stats', 'get', lambda s: (
+        reverse('cache-stats'), None)),
+    Scenario('contact detail', 'contact', 'get', lambda s: (
+        reverse('contact', kwargs={'id': s.user()['id']}), None)),
+    Scenario('add contact', 'contact', 'post', lambda s: (
+        reverse('contact', kwargs={'id': s.user()['id']}),
+        {"email": fake_user(s.rng)["emails"][0],
+         "phone_number": fake_user(s.rng)["phonenumbers"][0]})),
+    Scenario('update contacts', 'contact', 'put', lambda s: (
+        reverse('contact', kwargs={'id': s.user()['id']}),
+        {key: value for key, value in fake_user(s.rng).items()
+         if key in ('emails', 'phonenumbers')})),
+    Scenario('email detail', 'email', 'get', lambda s: s.contact_path(
+        'email', 'emails')),
+    Scenario('number detail', 'number', 'get', lambda s: s.contact_path(
+        'number', 'phonenumbers')),
+    Scenario('delete user', 'user', 'delete', lambda s: (
+        reverse('user'), {'id': s.created_user()})),
+]
+
+
+class State:
+    """Sampled users to aim requests at, refreshed before each scenario."""
+
+    def __init__(self, seed, size=500):
+        self.rng = random.Random(seed)
+        self.size = size
+        self.created = []
+        self.job = None
+
+    def refresh(self):
+        bounds = User.objects.order_by('id').values_list('id', flat=True)
+        first, last = bounds.first(), bounds.last()
+        ids = list(User.objects.filter(id__in=[
+            self.rng.randint(first, last) for _ in range(self.size)
+        ]).exclude(id__in=self.created).values_list('id', 'firstname'))
+        # a page behind the head of the change feed
+        self.change_cursor = max(0, (UserChange.objects.order_by(
+            '-id').values_list('id', flat=True).first() or 0) - 100)
+        snapshots = contact_snapshots([user_id for user_id, _ in ids])
+        self.users = [dict(snapshots[user_id], id=user_id,
+                           firstname=firstname) for user_id, firstname in ids]
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def created_user(self):
+        """A user made by this run, so deleting it does not skew others."""
+        if not self.created:
+            self.created = [user.id for user in create_users(
+                [fake_user(self.rng) for _ in range(100)])]
+        return self.created.pop()
+
+    def export_job(self):
+        """A finished export of the users of a first name."""
+        if self.job is None:
+            self.job = submit_export({'firstname': self.user()['firstname']},
+                                     USER_FIELDS).id
+            work(once=True, job_id=self.job)
+        return self.job
+
+    def contact(self, user, field):
+        return user[field][0][1] if user[field] else ''
+
+    def contact_path(self, route, field):
+        user = self.rng.choice([u for u in self.users if u[field]])
+        return reverse(route, kwargs={'id': user['id'],
+                                      'pk': user[field][0][0]}), None
+
+
+class Command(BaseCommand):
+    help = ("Benchmark every route of api/urls.py in-process: throughput, "
+            "p50/p95/p99 latency, queries and commits per request and, with "
+            "--trace-memory, peak allocated memory, written as JSON. With "
+            "--baseline or --thresholds it fails on regressions, for use in "
+            "CI.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=1000,
+                            help='Number of synthetic users to insert first.')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Requests per scenario.')
+        parser.add_argument('--only', nargs='*', default=[],
+                            help='Only run the scenarios with these labels.')
+        parser.add_argument('--output', help='Write the results to this file.')
+        parser.add_argument('--baseline',
+                            help='Results of an earlier run to compare with.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed relative p95 growth over baseline.')
+        parser.add_argument('--thresholds',
+                            help='JSON file of {label: {metric: max}}.')
+        parser.add_argument('--trace-memory', action='store_true',
+                            help='Report the peak memory allocated by each '
+                                 'scenario, traced with tracemalloc, which '
+                                 'slows the requests down.')
+        parser.add_argument('--use-existing-db', action='store_true',
+                            help='Run against the configured database '
+                                 'instead of a throwaway test database.')
+
+    def handle(self, *args, **options):
+        self._check_coverage()
+        old_name = None
+        if not options['use_existing_db']:
+            old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            with override_settings(ALLOWED_HOSTS=['*']):
+                results = self._run(options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
+
+        failures = self._regressions(results, options)
+        if failures:
+            raise CommandError('Benchmark regressions:\n  ' +
+                               '\n  '.join(failures))
+
+    def _check_coverage(self):
+        missing = ({p.name for p in urls.urlpatterns} -
+                   {scenario.route for scenario in SCENARIOS})
+        if missing:
+            raise CommandError('No benchmark scenario for routes: %s'
+                               % ', '.join(sorted(missing)))
+
+    def _run(self, options):
+        for created in seed_users(options['seed'], seed=0):
+            self.stderr.write('seeded %d users' % created, ending='\r')
+        self.stderr.write('')
+
+        client, state = Client(), State(seed=0)
+        results = {}
+        if options['trace_memory']:
+            tracemalloc.start()
+        try:
+            for scenario in SCENARIOS:
+                if options['only'] and scenario.label not in options['only']:
+                    continue
+                state.refresh()
+                results[scenario.label] = self._measure(
+                    client, state, scenario, options['requests'])
+                self.stderr.write('%-16s %s' % (
+                    scenario.label, json.dumps(results[scenario.label])))
+        finally:
+            tracemalloc.stop()
+        return results
+
+    def _measure(self, client, state, scenario, count):
+        send = getattr(client, scenario.method)
+        timings, queries, commits, errors = [], [], [], 0
+        # the process' peak RSS only grows, this peak is the scenario's own
+        tracemalloc.reset_peak()
+        for _ in range(count):
+            path, data = scenario.build(state)
+            if scenario.method == 'get':
+                kwargs = {'data': data}
+            else:
+                kwargs = {'data': data, 'content_type': 'application/json'}
+            # the query log is capped, long runs would stop filling it
+            reset_queries()
+            with CaptureQueriesContext(connection) as ctx, \
+                    CommitCounter(connection) as counter:
+                start = time.perf_counter()
+                response = send(path, **kwargs)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                timings.append(time.perf_counter() - start)
+            queries.append(len(ctx.captured_queries))
+            commits.append(counter.commits)
+            if response.status_code >= 400:
+                errors += 1
+            elif scenario.label == 'bulk create':
+                state.created += [user['id'] for user in response.json()]
+        result = summarize(timings, sum(timings))
+        result.update({
+            'route': scenario.route,
+            'method': scenario.method.upper(),
+            'errors': errors,
+            'queries_per_request': round(sum(queries) / len(queries), 2),
+            'max_queries': max(queries),
+            'commits_per_request': round(sum(commits) / len(commits), 2),
+        })
+        if tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            result['peak_alloc_kb'] = peak // 1024
+        return result
+
+    def _regressions(self, results, options):
+        failures = []
+        for label, result in results.items():
+            if result['errors']:
+                failures.append('%s: %d failed requests'
+                                % (label, result['errors']))
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            for label, result in results.items():
+                base = baseline.get(label)
+                if base is None:
+                    continue
+                if result['queries_per_request'] > base['queries_per_request']:
+                    failures.append('%s: %s queries per request, was %s' % (
+                        label, result['queries_per_request'],
+                        base['queries_per_request']))
+                if result['commits_per_request'] > base.get(
+                        'commits_per_request', float('inf')):
+                    failures.append('%s: %s commits per request, was %s' % (
+                        label, result['commits_per_request'],
+                        base['commits_per_request']))
+                if result['p95_ms'] > base['p95_ms'] * (
+                        1 + options['tolerance']):
+                    failures.append('%s: p95 %sms, was %sms' % (
+                        label, result['p95_ms'], base['p95_ms']))
+        if options['thresholds']:
+            with open(options['thresholds']) as f:
+                thresholds = json.load(f)
+            for label, limits in thresholds.items():
+                for metric, limit in limits.items():
+                    value = results.get(label, {}).get(metric)
+                    if value is not None and value > limit:
+                        failures.append('%s: %s %s over %s' % (
+                            label, metric, value, limit))
+        return failures
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.benchmarking import summarize
+
+
+class Command(BaseCommand):
+    help = ("Compare the cost of a request's first query with a new database "
+            "connection (CONN_MAX_AGE = 0) and with a persistent one.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+
+    def handle(self, *args, **options):
+        def query():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+
+        def run(reconnect):
+            timings = []
+            for _ in range(options['requests']):
+                if reconnect:
+                    connection.close()
+                start = time.perf_counter()
+                query()
+                timings.append(time.perf_counter() - start)
+            return summarize(timings, sum(timings))
+
+        connection.close()
+        for name, result in (('new connection', run(True)),
+                             ('persistent', run(False))):
+            self.stdout.write('%-15s p50 %7.3fms  p95 %7.3fms  p99 %7.3fms'
+                              % (name, result['p50_ms'], result['p95_ms'],
+                                 result['p99_ms']))
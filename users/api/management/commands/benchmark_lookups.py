@@ -0,0 +1,58 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models.functions import Lower
+
+from api.models import User, Email, PhoneNumber
+from api.seeding import seed_users
+
+
+class Command(BaseCommand):
+    help = ("Time the firstname/lastname/email/phone number lookups. Run it "
+            "once with `migrate api 0001` and once after `migrate` to "
+            "compare the latency with and without the lookup indexes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Insert this many synthetic users first.')
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--explain', action='store_true',
+                            help='Print the query plan of each lookup.')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            for created in seed_users(options['seed']):
+                self.stdout.write('seeded %d users' % created, ending='\r')
+            self.stdout.write('')
+
+        sample_user = User.objects.order_by('?').first()
+        if sample_user is None:
+            self.stderr.write('No users to look up, pass --seed N.')
+            return
+        sample_email = sample_user.emails.first()
+        sample_number = sample_user.phonenumbers.first()
+
+        lookups = {
+            'firstname': User.objects.filter(
+                firstname=sample_user.firstname),
+            'lastname': User.objects.filter(lastname=sample_user.lastname),
+            'email': Email.objects.annotate(email_lower=Lower('email'))
+                .filter(email_lower=sample_email.email.lower()),
+            'phone number': PhoneNumber.objects.filter(
+                number=sample_number.number),
+        }
+        self.stdout.write('%d users, %d repeats' % (User.objects.count(),
+                                                    options['repeat']))
+        for name, qs in lookups.items():
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                list(qs[:100])
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            self.stdout.write('%-13s mean %8.3fms  p95 %8.3fms' % (
+                name, statistics.mean(timings),
+                timings[int(len(timings) * 0.95) - 1]))
+            if options['explain']:
+                self.stdout.write(qs[:100].explain())
@@ -0,0 +1,55 @@
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from api.models import User
+from api.renderers import FastJSONRenderer
+from api.seeding import seed_users
+from api.serializers import (ListUsersSerializer, serialize_user_rows,
+                             user_rows)
+
+
+class Command(BaseCommand):
+    help = ("Compare CPU time and peak allocations of rendering the user "
+            "listing through model instances, ListUsersSerializer and DRF's "
+            "JSONRenderer with the values() rows and FastJSONRenderer path.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int,
+                            default=[1000, 10000, 100000])
+        parser.add_argument('--seed', action='store_true',
+                            help='Insert users until the largest size.')
+
+    def handle(self, *args, **options):
+        sizes = sorted(options['sizes'])
+        if options['seed']:
+            missing = sizes[-1] - User.objects.count()
+            for _ in seed_users(max(missing, 0)):
+                pass
+
+        def instances(qs):
+            return JSONRenderer().render(
+                ListUsersSerializer(qs.with_contacts(), many=True).data)
+
+        def lean(qs):
+            return FastJSONRenderer().render(serialize_user_rows(
+                list(user_rows(qs)), user_ids=qs.values('id')))
+
+        for size in sizes:
+            qs = User.objects.filter(id__in=User.objects.order_by(
+                'id').values('id')[:size])
+            for name, render in (('instances', instances), ('lean', lean)):
+                start = time.process_time()
+                body = render(qs)
+                cpu = time.process_time() - start
+                # separate run, tracing allocations slows everything down
+                tracemalloc.start()
+                render(qs)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.stdout.write(
+                    '%7d users  %-9s  cpu %8.1fms  peak alloc %8.1fMB  '
+                    'body %6.1fMB' % (size, name, cpu * 1000,
+                                      peak / 2 ** 20, len(body) / 2 ** 20))
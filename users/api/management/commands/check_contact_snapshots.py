@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.cache import invalidate_users
+from api.models import (User, UserChange, contact_snapshots, lock_users,
+                        record_changes, refresh_contact_snapshots)
+
+
+class Command(BaseCommand):
+    help = ("Verify the denormalized User.contacts column against the join "
+            "tables and report (or --fix) the users where they differ.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--fix', action='store_true',
+                            help='Rewrite the snapshots that differ.')
+
+    def handle(self, *args, **options):
+        mismatched, last_id = [], 0
+        while True:
+            batch = list(User.objects.filter(id__gt=last_id).order_by(
+                'id').values_list('id', 'contacts')[:options['batch_size']])
+            if not batch:
+                break
+            expected = contact_snapshots([user_id for user_id, _ in batch])
+            mismatched += [user_id for user_id, snapshot in batch
+                           if snapshot != expected[user_id]]
+            last_id = batch[-1][0]
+
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS('All snapshots match.'))
+            return
+        self.stdout.write('Snapshot differs for users: %s' % ', '.join(
+            str(user_id) for user_id in mismatched))
+        if not options['fix']:
+            raise CommandError('%d snapshots differ.' % len(mismatched))
+        batch_size = options['batch_size']
+        for start in range(0, len(mismatched), batch_size):
+            ids = mismatched[start:start + batch_size]
+            with transaction.atomic():
+                lock_users(ids)
+                refresh_contact_snapshots(ids)
+                record_changes(ids, UserChange.UPDATED)
+                invalidate_users(ids)
+        self.stdout.write(self.style.SUCCESS(
+            'Fixed %d snapshots.' % len(mismatched)))
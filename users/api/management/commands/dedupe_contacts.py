@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.cache import invalidate_users
+from api.dedupe import delete_unreferenced_contacts, merge_duplicate_contacts
+from api.models import (User, UserChange, record_changes,
+                        refresh_contact_snapshots)
+from api.normalization import normalize_email, normalize_phone
+
+CONTACT_FIELDS = [
+    ('emails', 'email', normalize_email),
+    ('phonenumbers', 'number', normalize_phone),
+]
+
+
+class Command(BaseCommand):
+    help = ("Normalize the stored emails and phone numbers, merge the ones "
+            "that are equal once normalized and delete the contacts no user "
+            "links to any more.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--keep-unreferenced', action='store_true',
+                            help='Do not delete unreferenced contacts.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        merged, deleted, users = 0, 0, set()
+        with transaction.atomic():
+            for field_name, value_field, normalize in CONTACT_FIELDS:
+                field = User._meta.get_field(field_name)
+                count, changed = merge_duplicate_contacts(
+                    field.related_model, field.remote_field.through,
+                    value_field, field.m2m_reverse_field_name(), normalize,
+                    batch_size=batch_size)
+                merged, users = merged + count, users | changed
+                if not options['keep_unreferenced']:
+                    deleted += delete_unreferenced_contacts(
+                        field.related_model)
+            users = sorted(users)
+            for start in range(0, len(users), batch_size):
+                refresh_contact_snapshots(users[start:start + batch_size])
+            record_changes(users, UserChange.UPDATED)
+            invalidate_users(users)
+        self.stdout.write(self.style.SUCCESS(
+            '%d duplicate contacts merged, %d unreferenced contacts deleted, '
+            '%d users updated.' % (merged, deleted, len(users))))
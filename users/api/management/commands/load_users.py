@@ -0,0 +1,68 @@
+import random
+import time
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.loading import (FORMATS, file_format, load_users, read_users,
+                         write_users)
+from api.seeding import fake_user
+
+
+class Command(BaseCommand):
+    help = ("Load users and their contacts from CSV or NDJSON files, with "
+            "COPY into staging tables and set-based INSERT .. SELECT on "
+            "PostgreSQL, or generate a synthetic dataset of a given size. "
+            "CSV files have lastname, firstname, emails and phonenumbers "
+            "columns, several values separated by ';'.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*',
+                            help='CSV (.csv) or NDJSON files to load.')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='Format of the files, by default from their '
+                                 'extension (NDJSON unless .csv).')
+        parser.add_argument('--generate', type=int, default=0,
+                            help='Number of synthetic users to load.')
+        parser.add_argument('--seed', type=int,
+                            help='Random seed of the synthetic users.')
+        parser.add_argument('--write',
+                            help='Write the synthetic users to this file '
+                                 'instead of loading them.')
+        parser.add_argument('--batch-size', type=int, default=50000,
+                            help='Users per transaction.')
+
+    def handle(self, *args, **options):
+        if not options['files'] and not options['generate']:
+            raise CommandError('Give files to load or --generate.')
+        rng = random.Random(options['seed'])
+        generated = (fake_user(rng) for _ in range(options['generate']))
+
+        if options['write']:
+            fmt = options['format'] or file_format(options['write'])
+            with open(options['write'], 'w', newline='') as f:
+                write_users(generated, f, fmt)
+            self.stdout.write(self.style.SUCCESS(
+                '%d users written to %s.' % (options['generate'],
+                                             options['write'])))
+            return
+
+        start, loaded = time.perf_counter(), 0
+        for loaded in load_users(chain(self._read(options), generated),
+                                 batch_size=options['batch_size']):
+            self.stderr.write('loaded %d users' % loaded, ending='\r')
+        self.stderr.write('')
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            '%d users loaded in %.1fs, %d rows/sec.' % (
+                loaded, elapsed, loaded / elapsed if elapsed else 0)))
+
+    def _read(self, options):
+        for path in options['files']:
+            try:
+                f = open(path, newline='')
+            except OSError as exc:
+                raise CommandError(exc)
+            with f:
+                yield from read_users(f, options['format'] or
+                                      file_format(path))
@@ -0,0 +1,76 @@
+import http.client
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+
+from api.benchmarking import summarize
+
+
+class Command(BaseCommand):
+    help = ("Drive a running server with concurrent keep-alive GET requests "
+            "and report requests/sec and latency percentiles, e.g. to "
+            "compare the WSGI workers with the ASGI server on the same URL.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='+')
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--requests', type=int, default=5000,
+                            help='Total number of requests per URL.')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        results = {url: self._run(url, options['concurrency'],
+                                  options['requests'])
+                   for url in options['urls']}
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for url, result in results.items():
+            self.stdout.write(
+                '%s\n  %d requests, %d errors, %.1f req/s, p50 %.1fms, '
+                'p95 %.1fms, p99 %.1fms' % (
+                    url, result['requests'], result['errors'], result['rps'],
+                    result['p50_ms'], result['p95_ms'], result['p99_ms']))
+
+    def _run(self, url, concurrency, total):
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        counter = itertools.count()
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def worker():
+            connection = http.client.HTTPConnection(parts.netloc, timeout=30)
+            timings, failed = [], 0
+            while next(counter) < total:
+                start = time.perf_counter()
+                try:
+                    connection.request('GET', path)
+                    response = connection.getresponse()
+                    response.read()
+                    if response.status >= 500:
+                        failed += 1
+                except (OSError, http.client.HTTPException):
+                    failed += 1
+                    connection.close()
+                    connection = http.client.HTTPConnection(parts.netloc,
+                                                            timeout=30)
+                timings.append(time.perf_counter() - start)
+            connection.close()
+            with lock:
+                latencies.extend(timings)
+                errors.append(failed)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(worker)
+        result = summarize(latencies, time.perf_counter() - start)
+        result['errors'] = sum(errors)
+        return result
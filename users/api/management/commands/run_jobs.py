@@ -0,0 +1,37 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.jobs import work
+
+
+class Command(BaseCommand):
+    help = ("Run the partitions of the submitted import and export jobs in a "
+            "pool of worker processes. Kill it at any time: the partitions "
+            "in progress are rolled back and run again by the next workers "
+            "once their claim expires (JOB_LEASE_SECONDS).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when no partition is left to run.')
+        parser.add_argument('--poll', type=float, default=1.0,
+                            help='Seconds to wait when there is no work.')
+
+    def handle(self, *args, **options):
+        workers, once, poll = options['workers'], options['once'], \
+            options['poll']
+        if workers <= 1:
+            ran = work(once=once, poll=poll)
+        else:
+            # each worker opens its own connections
+            connections.close_all()
+            with ProcessPoolExecutor(workers,
+                                     initializer=django.setup) as pool:
+                ran = sum(future.result() for future in [
+                    pool.submit(work, once, poll) for _ in range(workers)])
+        self.stdout.write(self.style.SUCCESS('%d partitions run.' % ran))
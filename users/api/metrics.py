@@ -0,0 +1,108 @@
+"""
+Per-request SQL and timing instrumentation, see RequestMetricsMiddleware.
+
+The middleware puts a `RequestMetrics` in `current` for the duration of a
+request; `timed_representation` adds the time spent in the decorated
+`to_representation` methods to it. With the middleware disabled `current`
+stays empty and the decorator only does a context variable lookup.
+"""
+import functools
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+from .cache import stats
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self._depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # a connection.execute_wrapper counting every query of the request
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+
+def timed_representation(method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        metrics = current.get()
+        if metrics is None or metrics._depth:
+            return method(*args, **kwargs)
+        metrics._depth += 1
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            metrics.serializer_time += time.perf_counter() - start
+            metrics._depth -= 1
+    return wrapper
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+_lock = threading.Lock()
+_histograms = defaultdict(Histogram)
+_queries = defaultdict(int)
+
+
+def observe(route, method, status, duration, metrics):
+    with _lock:
+        _histograms[route, method, status // 100].observe(duration)
+        _queries[route, method] += metrics.queries
+
+
+def render_prometheus():
+    """The aggregated metrics of this process in Prometheus text format."""
+    lines = ['# TYPE api_request_duration_seconds histogram']
+    with _lock:
+        for (route, method, status), histogram in sorted(
+                _histograms.items()):
+            labels = 'route="%s",method="%s",status="%dxx"' % (
+                route, method, status)
+            for bound, count in zip(BUCKETS, histogram.counts):
+                lines.append('api_request_duration_seconds_bucket{%s,le="%s"}'
+                             ' %d' % (labels, bound, count))
+            lines.append('api_request_duration_seconds_bucket{%s,le="+Inf"}'
+                         ' %d' % (labels, histogram.count))
+            lines.append('api_request_duration_seconds_sum{%s} %f'
+                         % (labels, histogram.sum))
+            lines.append('api_request_duration_seconds_count{%s} %d'
+                         % (labels, histogram.count))
+        lines.append('# TYPE api_request_db_queries_total counter')
+        for (route, method), count in sorted(_queries.items()):
+            lines.append('api_request_db_queries_total{route="%s",'
+                         'method="%s"} %d' % (route, method, count))
+    cache_stats = stats()
+    lines.append('# TYPE api_user_cache_hits_total counter')
+    lines.append('api_user_cache_hits_total %d' % cache_stats['hits'])
+    lines.append('# TYPE api_user_cache_misses_total counter')
+    lines.append('api_user_cache_misses_total %d' % cache_stats['misses'])
+    return '\n'.join(lines) + '\n'
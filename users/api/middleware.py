@@ -0,0 +1,62 @@
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+from django.http import HttpResponse
+
+from .metrics import RequestMetrics, current, observe, render_prometheus
+
+logger = logging.getLogger('api.metrics')
+
+
+class RequestMetricsMiddleware:
+    """
+    Record the number of queries, DB time and serializer time of every
+    request, send them back as a `Server-Timing` header, log them as one
+    JSON line and aggregate them per route for `metrics_view`.
+
+    Enabled with the REQUEST_METRICS environment variable, see settings.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        route = match.view_name if match else 'unmatched'
+        response['Server-Timing'] = (
+            'db;dur=%.3f;desc="%d queries", ser;dur=%.3f, total;dur=%.3f' % (
+                metrics.db_time * 1000, metrics.queries,
+                metrics.serializer_time * 1000, duration * 1000))
+        observe(route, request.method, response.status_code, duration,
+                metrics)
+        logger.info(json.dumps({
+            'view': route,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': metrics.queries,
+            'db_ms': round(metrics.db_time * 1000, 3),
+            'serializer_ms': round(metrics.serializer_time * 1000, 3),
+            'total_ms': round(duration * 1000, 3),
+        }))
+        return response
+
+
+def metrics_view(request):
+    return HttpResponse(render_prometheus(),
+                        content_type='text/plain; version=0.0.4')
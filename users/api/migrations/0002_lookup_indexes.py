@@ -0,0 +1,30 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:11
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='api_email_email_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phonenumber',
+            index=models.Index(fields=['number'], name='api_phonenumber_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['firstname'], name='api_user_firstname_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['lastname'], name='api_user_lastname_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:13
+
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='phonenumber',
+            index=models.Index(django.db.models.functions.text.Replace(django.db.models.functions.text.Replace(django.db.models.functions.text.Replace(django.db.models.functions.text.Replace(django.db.models.functions.text.Replace(django.db.models.functions.text.Replace(django.db.models.expressions.F('number'), django.db.models.expressions.Value(' '), django.db.models.expressions.Value('')), django.db.models.expressions.Value('-'), django.db.models.expressions.Value('')), django.db.models.expressions.Value('.'), django.db.models.expressions.Value('')), django.db.models.expressions.Value('('), django.db.models.expressions.Value('')), django.db.models.expressions.Value(')'), django.db.models.expressions.Value('')), django.db.models.expressions.Value('/'), django.db.models.expressions.Value('')), name='api_phonenumber_e164_idx'),
+        ),
+    ]
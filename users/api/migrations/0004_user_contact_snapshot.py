@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_phone_lookup_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='contacts',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
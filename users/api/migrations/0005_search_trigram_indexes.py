@@ -0,0 +1,45 @@
+from django.db import migrations, transaction
+
+# (table, column) pairs searched with icontains, which Postgres compiles to
+# UPPER(column::text) LIKE UPPER(pattern), hence the UPPER() expressions
+TRIGRAM_INDEXES = [
+    ('api_user', 'firstname'),
+    ('api_user', 'lastname'),
+    ('api_email', 'email'),
+    ('api_phonenumber', 'number'),
+]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except Exception:
+        # without pg_trgm the search falls back to unindexed matching
+        return
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS %s_%s_trgm ON %s '
+            'USING gin (UPPER(%s::text) gin_trgm_ops)'
+            % (table, column, table, column))
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s_%s_trgm'
+                              % (table, column))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_user_contact_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+from api.dedupe import merge_duplicate_contacts
+from api.normalization import normalize_email, normalize_phone
+
+
+def merge_contacts(apps, schema_editor):
+    User = apps.get_model('api', 'User')
+    users = set()
+    for model_name, field_name, value_field, normalize in (
+            ('Email', 'emails', 'email', normalize_email),
+            ('PhoneNumber', 'phonenumbers', 'number', normalize_phone)):
+        field = User._meta.get_field(field_name)
+        _, changed = merge_duplicate_contacts(
+            apps.get_model('api', model_name), field.remote_field.through,
+            value_field, field.m2m_reverse_field_name(), normalize)
+        users |= changed
+    # stale snapshots are read from the join tables until backfilled again
+    users = list(users)
+    for start in range(0, len(users), 1000):
+        User.objects.filter(id__in=users[start:start + 1000]).update(
+            contacts=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_contacts, migrations.RunPython.noop),
+    ]
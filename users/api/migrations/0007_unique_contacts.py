@@ -0,0 +1,35 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_merge_duplicate_contacts'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='email',
+            name='api_email_email_lower_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='phonenumber',
+            name='api_phonenumber_number_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='phonenumber',
+            name='api_phonenumber_e164_idx',
+        ),
+        migrations.AlterField(
+            model_name='email',
+            name='email',
+            field=models.EmailField(max_length=1024, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='phonenumber',
+            name='number',
+            field=models.CharField(max_length=24, unique=True),
+        ),
+    ]
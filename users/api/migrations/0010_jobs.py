@@ -0,0 +1,57 @@
+# Generated by Django 4.0.4 on 2026-10-18 18:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_user_change_feed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('import', 'import'), ('export', 'export')], max_length=6)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=7)),
+                ('params', models.JSONField(default=dict)),
+                ('partitions', models.PositiveIntegerField(default=0)),
+                ('done_partitions', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(null=True)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('failed_rows', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='JobPartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=7)),
+                ('start', models.BigIntegerField()),
+                ('end', models.BigIntegerField()),
+                ('payload', models.JSONField(null=True)),
+                ('output', models.TextField(blank=True)),
+                ('errors', models.JSONField(default=list)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('claimed_at', models.DateTimeField(null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='api.job')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='jobpartition',
+            index=models.Index(fields=['status'], name='api_jobpartition_status_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='jobpartition',
+            constraint=models.UniqueConstraint(fields=('job', 'number'), name='api_jobpartition_job_number_uniq'),
+        ),
+    ]
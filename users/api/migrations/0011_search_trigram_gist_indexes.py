@@ -0,0 +1,53 @@
+from django.db import migrations
+
+# the columns of migration 0005; GiST indexes serve the icontains filter
+# like its GIN ones and also the nearest first order (<->) of the search
+TRIGRAM_INDEXES = [
+    ('api_user', 'firstname'),
+    ('api_user', 'lastname'),
+    ('api_email', 'email'),
+    ('api_phonenumber', 'number'),
+]
+
+
+def _trigram_installed(schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return False
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+
+def gin_to_gist(apps, schema_editor):
+    if not _trigram_installed(schema_editor):
+        return
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS %s_%s_trgm_gist ON %s '
+            'USING gist (UPPER(%s::text) gist_trgm_ops)'
+            % (table, column, table, column))
+        schema_editor.execute('DROP INDEX IF EXISTS %s_%s_trgm'
+                              % (table, column))
+
+
+def gist_to_gin(apps, schema_editor):
+    if not _trigram_installed(schema_editor):
+        return
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS %s_%s_trgm ON %s '
+            'USING gin (UPPER(%s::text) gin_trgm_ops)'
+            % (table, column, table, column))
+        schema_editor.execute('DROP INDEX IF EXISTS %s_%s_trgm_gist'
+                              % (table, column))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_jobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(gin_to_gist, gist_to_gin),
+    ]
@@ -1,12 +1,30 @@
+from collections import defaultdict
+
+from django.conf import settings
 from django.db import models
+from django.db.models import (DateTimeField, Exists, F, IntegerField,
+                              OuterRef, Subquery, Value)
+from django.utils import timezone
 
 
+# Contacts are stored once per normalized value (see api/normalization.py)
+# and shared by every user that has them.
 class Email(models.Model):
-    email = models.EmailField(max_length=1024)
+    email = models.EmailField(max_length=1024, unique=True)
 
 
 class PhoneNumber(models.Model):
-    number = models.CharField(max_length=24)
+    number = models.CharField(max_length=24, unique=True)
+
+
+class UserQuerySet(models.QuerySet):
+
+    def with_contacts(self):
+        # loads both contact collections in one query each, whatever the
+        # number of users, instead of two queries per serialized user
+        if settings.USER_CONTACT_SNAPSHOT_READS:
+            return self
+        return self.prefetch_related('emails', 'phonenumbers')
 
 
 class User(models.Model):
@@ -14,3 +32,339 @@ class User(models.Model):
     firstname = models.CharField(max_length=255)
     emails = models.ManyToManyField('api.Email', default=[])
     phonenumbers = models.ManyToManyField('api.PhoneNumber', default=[])
+    # denormalized copy of both contact collections, see contact_snapshots()
+    contacts = models.JSONField(null=True, blank=True, editable=False)
+    # bumped by refresh_contact_snapshots() on every contact change
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['firstname'], name='api_user_firstname_idx'),
+            models.Index(fields=['lastname'], name='api_user_lastname_idx'),
+        ]
+
+    # set by load_user_detail(), whose snapshot is read from the join tables
+    fresh_contacts = False
+
+    def contact_pairs(self):
+        """
+        The user's emails and phone numbers as lists of `[id, value]` pairs,
+        read from the snapshot column when USER_CONTACT_SNAPSHOT_READS is on
+        and the row has one (or when built by load_user_detail()), from the
+        M2M relations otherwise.
+        """
+        if self.contacts is not None and (
+                self.fresh_contacts or settings.USER_CONTACT_SNAPSHOT_READS):
+            return self.contacts["emails"], self.contacts["phonenumbers"]
+        return ([[i.id, i.email] for i in self.emails.all()],
+                [[i.id, i.number] for i in self.phonenumbers.all()])
+
+
+class UserChange(models.Model):
+    """
+    Append-only log of the writes to users, read by the change feed: the
+    id is the feed's cursor, and `user_id` is no foreign key so that the
+    tombstones of deleted users stay. Rows are written last in each write
+    transaction, see record_changes().
+    """
+    CREATED, UPDATED, DELETED = 'created', 'updated', 'deleted'
+    KINDS = [(CREATED, 'created'), (UPDATED, 'updated'), (DELETED, 'deleted')]
+
+    user_id = models.BigIntegerField()
+    kind = models.CharField(max_length=7, choices=KINDS)
+    at = models.DateTimeField(default=timezone.now)
+
+
+class Job(models.Model):
+    """
+    A background import or export, split into JobPartitions that the
+    workers of `manage.py run_jobs` claim and run independently, see
+    api/jobs.py.
+    """
+    IMPORT, EXPORT = 'import', 'export'
+    KINDS = [(IMPORT, 'import'), (EXPORT, 'export')]
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUSES = [(PENDING, 'pending'), (RUNNING, 'running'), (DONE, 'done'),
+                (FAILED, 'failed')]
+
+    kind = models.CharField(max_length=6, choices=KINDS)
+    status = models.CharField(max_length=7, choices=STATUSES,
+                              default=PENDING)
+    # export: the `filters` and `fields` of the export
+    params = models.JSONField(default=dict)
+    partitions = models.PositiveIntegerField(default=0)
+    done_partitions = models.PositiveIntegerField(default=0)
+    # import: the number of submitted rows, of users created and of rows
+    # rejected; export: the number of users written
+    total = models.PositiveIntegerField(null=True)
+    processed = models.PositiveIntegerField(default=0)
+    failed_rows = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+
+class JobPartition(models.Model):
+    job = models.ForeignKey(Job, on_delete=models.CASCADE,
+                            related_name='parts')
+    number = models.PositiveIntegerField()
+    status = models.CharField(max_length=7, choices=Job.STATUSES,
+                              default=Job.PENDING)
+    # import: the offsets of `payload` in the submitted rows; export: the
+    # range of user ids, both [start, end)
+    start = models.BigIntegerField()
+    end = models.BigIntegerField()
+    payload = models.JSONField(null=True)
+    # export: the NDJSON lines of the partition's users
+    output = models.TextField(blank=True)
+    # import: `{"row": offset, "errors": ..}` of each rejected row
+    errors = models.JSONField(default=list)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # the claim of the worker running it, which expires after
+    # JOB_LEASE_SECONDS
+    claimed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'number'],
+                                    name='api_jobpartition_job_number_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['status'],
+                         name='api_jobpartition_status_idx'),
+        ]
+
+
+def lock_users(user_ids):
+    """
+    Lock the rows of `user_ids` until the end of the transaction, so that
+    concurrent contact writes to a user run one after the other and each
+    rebuilds its snapshot from the links of the previous ones.
+    """
+    list(User.objects.select_for_update().filter(
+        id__in=user_ids).values_list('id', flat=True))
+
+
+def record_changes(user_ids, kind):
+    """
+    Log a `kind` change of each of `user_ids`. Call it as the last statement
+    of the write transaction: the feed holds back at a missing cursor value
+    until it has been missing for USER_CHANGES_SETTLE_SECONDS.
+    """
+    UserChange.objects.bulk_create(
+        [UserChange(user_id=user_id, kind=kind) for user_id in user_ids],
+        batch_size=1000)
+
+
+def ensure_contacts(model, value_field, values, batch_size=1000):
+    """
+    Map each of the normalized `values` to the id of the `model` row holding
+    it, inserting the missing ones with INSERT .. ON CONFLICT DO NOTHING so
+    that concurrent writers of the same value end up sharing one row.
+
+    The rows are locked until the end of the transaction, so that
+    `delete_unlinked_contacts` in another one cannot delete them before they
+    are linked. Values are locked and inserted sorted, so that concurrent
+    transactions on the same values wait for each other instead of
+    deadlocking.
+    """
+    def lock(values):
+        ids.update(model.objects.select_for_update(no_key=True).filter(**{
+            value_field + '__in': values,
+        }).order_by(value_field).values_list(value_field, 'id'))
+        return [value for value in values if value not in ids]
+
+    values, ids = sorted(set(values)), {}
+    for start in range(0, len(values), batch_size):
+        missing = lock(values[start:start + batch_size])
+        # a row deleted before it could be locked is inserted again
+        while missing:
+            model.objects.bulk_create(
+                [model(**{value_field: value}) for value in missing],
+                ignore_conflicts=True)
+            missing = lock(missing)
+    return ids
+
+
+def load_user_detail(user_id):
+    """
+    User `user_id` with its contacts, in a single UNION ALL statement of the
+    user row and its email and phone number rows; `None` if no such user.
+    """
+    # columns: kind, contact or user id, value or lastname, firstname,
+    # updated_at, join table id; annotated in the same order in every part
+    def select(queryset, kind, pk, value, firstname, updated_at, link):
+        return queryset.annotate(
+            row_kind=Value(kind, output_field=IntegerField()), row_id=pk,
+            row_value=value, row_firstname=firstname,
+            row_updated_at=updated_at, row_link=link,
+        ).values_list('row_kind', 'row_id', 'row_value', 'row_firstname',
+                      'row_updated_at', 'row_link')
+
+    def contact_rows(kind, field_name, value_field):
+        field = User._meta.get_field(field_name)
+        target = field.m2m_reverse_field_name()
+        return select(field.remote_field.through.objects.filter(
+            user_id=user_id), kind, F(target + '_id'),
+            F(target + '__' + value_field),
+            Value(None, output_field=models.CharField()),
+            Value(None, output_field=DateTimeField()), F('id'))
+
+    rows = select(User.objects.filter(id=user_id), 0, F('id'), F('lastname'),
+                F('firstname'), F('updated_at'),
+                Value(0, output_field=models.BigIntegerField())).union(
+        contact_rows(1, 'emails', 'email'),
+        contact_rows(2, 'phonenumbers', 'number'), all=True)
+    user, contacts = None, {1: [], 2: []}
+    # ordered by join table id like the snapshots
+    for kind, pk, value, firstname, updated_at, _ in sorted(
+            rows, key=lambda row: (row[0], row[5])):
+        if kind == 0:
+            user = User(id=pk, lastname=value, firstname=firstname,
+                        updated_at=updated_at)
+        else:
+            contacts[kind].append([pk, value])
+    if user is not None:
+        user.contacts = {"emails": contacts[1], "phonenumbers": contacts[2]}
+        user.fresh_contacts = True
+    return user
+
+
+def load_user_details(user_ids):
+    """
+    The users of `user_ids` that exist, with their contacts read in one
+    query per contact type (none with USER_CONTACT_SNAPSHOT_READS).
+    """
+    if settings.USER_CONTACT_SNAPSHOT_READS:
+        users = list(User.objects.filter(id__in=user_ids))
+        missing = [user.id for user in users if user.contacts is None]
+    else:
+        users = list(User.objects.filter(id__in=user_ids).defer('contacts'))
+        missing = [user.id for user in users]
+    snapshots = contact_snapshots(missing) if missing else {}
+    for user in users:
+        if user.id in snapshots:
+            user.contacts = snapshots[user.id]
+            user.fresh_contacts = True
+    return users
+
+
+def user_contact(field_name, value_field, user_id, contact_id):
+    """
+    The value of contact `contact_id` of `User.<field_name>` and the user's
+    `updated_at`, in one statement scoped by an EXISTS on the join table;
+    `None` unless the user has that contact.
+    """
+    field = User._meta.get_field(field_name)
+    links = field.remote_field.through.objects.filter(**{
+        'user_id': user_id,
+        field.m2m_reverse_field_name() + '_id': OuterRef('pk'),
+    })
+    return field.related_model.objects.filter(
+        Exists(links), pk=contact_id,
+    ).values_list(value_field, Subquery(User.objects.filter(
+        id=user_id).values('updated_at'))).first()
+
+
+def contacts_by_user(user_ids, fields=('emails', 'phonenumbers')):
+    """
+    Batch-load contacts for `user_ids` straight from the M2M join tables.
+
+    Returns two dicts mapping user id to its list of emails and phone
+    numbers, in insertion order, using one query per contact type of
+    `fields`; the other dict is left empty.
+    """
+    emails, numbers = defaultdict(list), defaultdict(list)
+    if 'emails' in fields:
+        for user_id, email in User.emails.through.objects.filter(
+                user_id__in=user_ids).order_by('id').values_list(
+                'user_id', 'email__email'):
+            emails[user_id].append(email)
+    if 'phonenumbers' in fields:
+        for user_id, number in User.phonenumbers.through.objects.filter(
+                user_id__in=user_ids).order_by('id').values_list(
+                'user_id', 'phonenumber__number'):
+            numbers[user_id].append(number)
+    return emails, numbers
+
+
+def contact_snapshots(user_ids):
+    """
+    Build the `User.contacts` snapshot of each of `user_ids` from the M2M
+    join tables: `{"emails": [[id, email], ..], "phonenumbers": [..]}`.
+    """
+    snapshots = {user_id: {"emails": [], "phonenumbers": []}
+                 for user_id in user_ids}
+    for field_name, value_field in (("emails", "email"),
+                                    ("phonenumbers", "number")):
+        field = User._meta.get_field(field_name)
+        target = field.m2m_reverse_field_name()
+        links = field.remote_field.through.objects.filter(
+            user_id__in=user_ids).order_by('id')
+        for user_id, contact_id, value in links.values_list(
+                'user_id', target + '_id', target + '__' + value_field):
+            snapshots[user_id][field_name].append([contact_id, value])
+    return snapshots
+
+
+def refresh_contact_snapshots(user_ids):
+    """
+    Rewrite the snapshot column of `user_ids` from the join tables and bump
+    their `updated_at`, as called after every change to their contacts.
+    """
+    now = timezone.now()
+    User.objects.bulk_update(
+        [User(id=user_id, contacts=snapshot, updated_at=now)
+         for user_id, snapshot in contact_snapshots(user_ids).items()],
+        ['contacts', 'updated_at'], batch_size=1000)
+
+
+def delete_users(queryset, batch_size=5000):
+    """
+    Delete the users of `queryset`, their contact links and the contacts no
+    remaining user links to, with a few set-based statements per batch of
+    users instead of Django's per-object delete collector. Run it inside a
+    transaction.
+
+    Returns the deleted user ids and the number of deleted users, emails
+    and phone numbers.
+    """
+    user_ids = list(queryset.values_list('id', flat=True))
+    counts = {'users': 0, 'emails': 0, 'phonenumbers': 0}
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        contacts = {}
+        for field_name in ('emails', 'phonenumbers'):
+            field = User._meta.get_field(field_name)
+            links = field.remote_field.through.objects.filter(
+                user_id__in=batch)
+            contacts[field] = set(links.values_list(
+                field.m2m_reverse_field_name() + '_id', flat=True))
+            links._raw_delete(links.db)
+        users = User.objects.filter(id__in=batch)
+        counts['users'] += users._raw_delete(users.db)
+        for field, contact_ids in contacts.items():
+            counts[field.name] += delete_unlinked_contacts(
+                field.related_model, contact_ids)
+    record_changes(user_ids, UserChange.DELETED)
+    return user_ids, counts
+
+
+def delete_unlinked_contacts(model, contact_ids):
+    """
+    Delete those of the `model` rows `contact_ids` no user links to, and
+    return their number. Rows locked by `ensure_contacts` in a transaction
+    still in progress are about to be linked and are skipped; those that end
+    up unlinked anyway are left to `manage.py dedupe_contacts`.
+    """
+    field = model._meta.get_field('user').field
+    links = field.remote_field.through.objects.filter(**{
+        field.m2m_reverse_field_name(): OuterRef('id')})
+    unlinked = list(model.objects.select_for_update(skip_locked=True).filter(
+        ~Exists(links), id__in=contact_ids).values_list('id', flat=True))
+    deleted = model.objects.filter(id__in=unlinked)
+    return deleted._raw_delete(deleted.db)
@@ -0,0 +1,19 @@
+PHONE_FORMATTING = (' ', '-', '.', '(', ')', '/')
+
+
+def normalize_email(value):
+    return value.strip().lower()
+
+
+def normalize_phone(value):
+    """
+    Reduce a phone number to its E.164-like form: formatting characters are
+    dropped and an international `00` prefix becomes `+`.
+    """
+    value = value.strip()
+    for char in PHONE_FORMATTING:
+        value = value.replace(char, '')
+    if value.startswith('00'):
+        value = '+' + value[2:]
+    return value
+
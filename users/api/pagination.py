@@ -0,0 +1,125 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opt-in cursor pagination over the primary key: `?after=<id>&limit=N`.
+
+    Pages are fetched with `WHERE id > after ORDER BY id LIMIT N`, so the
+    cost of a page does not depend on how deep into the table it is.
+    """
+    after_query_param = 'after'
+    limit_query_param = 'limit'
+    default_limit = 100
+    max_limit = 1000
+
+    def page_queryset(self, queryset, request):
+        """
+        The slice of `queryset` the requested page is read from (one row
+        longer, to tell whether there is a next page), `None` if the request
+        is not paginated.
+        """
+        params = request.query_params
+        if (self.after_query_param not in params and
+                self.limit_query_param not in params):
+            return None
+
+        after = self._get_int(params, self.after_query_param, 0, minimum=0)
+        self.limit = min(self._get_int(params, self.limit_query_param,
+                                       self.default_limit, minimum=1),
+                         self.max_limit)
+        return queryset.filter(id__gt=after).order_by('id')[:self.limit + 1]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page = self.page_queryset(queryset, request)
+        if page is None:
+            return None
+        page, limit = list(page), self.limit
+        self.next_cursor = None
+        if len(page) > limit:
+            last = page[limit - 1]
+            # model instances or values() dicts
+            self.next_cursor = last['id'] if isinstance(last, dict) \
+                else last.id
+        return page[:limit]
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.next_cursor, 'results': data})
+
+    def _get_int(self, params, name, default, minimum):
+        value = params.get(name)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValidationError({name: 'A valid integer is required.'})
+        if value < minimum:
+            raise ValidationError(
+                {name: 'Ensure this value is greater than or equal to %d.'
+                       % minimum})
+        return value
+
+
+class RankedPagination(KeysetPagination):
+    """
+    `?limit=N&offset=M` pagination of search results, which are ordered by
+    rank rather than by id. `next` is the offset of the following page.
+    """
+    offset_query_param = 'offset'
+    default_limit = 20
+    max_limit = 100
+    max_offset = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        offset = min(self._get_int(params, self.offset_query_param, 0,
+                                   minimum=0), self.max_offset)
+        limit = min(self._get_int(params, self.limit_query_param,
+                                  self.default_limit, minimum=1),
+                    self.max_limit)
+        page = list(queryset[offset:offset + limit + 1])
+        self.next_cursor = offset + limit if len(page) > limit else None
+        return page[:limit]
+
+
+class ChangeFeedPagination(KeysetPagination):
+    """
+    Keyset pagination of the change log that always paginates and always
+    returns the cursor to resume from, with `more` telling whether to ask
+    again right away.
+
+    Cursor values are taken in insertion order but committed in any order,
+    so a page ends before a missing value younger than
+    USER_CHANGES_SETTLE_SECONDS: the transaction that holds it may still
+    commit. Older gaps are rolled back transactions.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        after = self._get_int(params, self.after_query_param, 0, minimum=0)
+        limit = min(self._get_int(params, self.limit_query_param,
+                                  self.default_limit, minimum=1),
+                    self.max_limit)
+        rows = list(queryset.filter(id__gt=after).order_by('id')[:limit + 1])
+        settled = timezone.now() - timedelta(
+            seconds=settings.USER_CHANGES_SETTLE_SECONDS)
+        page, last = [], after
+        for row in rows[:limit]:
+            if row.id != last + 1 and row.at > settled:
+                break
+            page.append(row)
+            last = row.id
+        self.cursor = last
+        self.more = len(page) == limit and len(rows) > limit
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({'cursor': self.cursor, 'more': self.more,
+                         'results': data})
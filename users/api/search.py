@@ -0,0 +1,112 @@
+"""
+Substring search over user names and contacts for `?q=`.
+
+Candidates are the SEARCH_MAX_CANDIDATES best `icontains` matches of each
+of the first names, last names, emails and phone numbers. With pg_trgm,
+Postgres reads them nearest first from the GiST trigram indexes of
+migration 0011 and stops at the cap; otherwise (e.g. SQLite) every match is
+scored, exact > prefix > substring, in one scan per column. Users are then
+ranked by their best matching name, email or phone number, by trigram
+similarity when pg_trgm is available and by exact > prefix > substring
+match otherwise.
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models import (Case, FloatField, IntegerField, OuterRef,
+                              Subquery, TextField, Value, When)
+from django.db.models.functions import Cast, Coalesce, Greatest, Upper
+
+from .models import User
+
+_trigram = {}
+
+
+def trigram_available():
+    if connection.vendor != 'postgresql':
+        return False
+    if connection.alias not in _trigram:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension "
+                           "WHERE extname = 'pg_trgm'")
+            _trigram[connection.alias] = cursor.fetchone() is not None
+    return _trigram[connection.alias]
+
+
+def _scorer(q):
+    """
+    How well a column matches `q`, as a function of the column's path, and
+    the score of no match: trigram similarity with pg_trgm, 3 for an exact,
+    2 for a prefix and 1 for a substring match otherwise.
+    """
+    if trigram_available():
+        from django.contrib.postgres.search import TrigramSimilarity
+        return (lambda path: TrigramSimilarity(path, q),
+                Value(0.0, output_field=FloatField()))
+
+    def score(path):
+        return Case(
+            When(**{path + '__iexact': q}, then=Value(3)),
+            When(**{path + '__istartswith': q}, then=Value(2)),
+            When(**{path + '__icontains': q}, then=Value(1)),
+            default=Value(0), output_field=IntegerField())
+    return score, Value(0)
+
+
+def _contact_sources():
+    field_paths = [('emails', 'email__email'),
+                   ('phonenumbers', 'phonenumber__number')]
+    for field_name, path in field_paths:
+        yield User._meta.get_field(field_name).remote_field.through, path
+
+
+def _best_matches(model, column, q, limit):
+    """
+    The ids of the at most `limit` rows of `model` whose `column` contains
+    `q` and match it best.
+    """
+    matches = model.objects.filter(**{column + '__icontains': q})
+    if trigram_available():
+        from django.contrib.postgres.search import TrigramDistance
+        # nearest first, straight from the GiST index of migration 0011,
+        # which also serves the icontains filter
+        distance = TrigramDistance(Upper(Cast(column, TextField())),
+                                   Upper(Value(q)))
+        return list(matches.order_by(distance).values_list(
+            'id', flat=True)[:limit])
+    # unindexed: one scan, keeping the best `limit` in a top-N sort
+    return list(matches.annotate(score=_scorer(q)[0](column)).order_by(
+        '-score', 'id').values_list('id', flat=True)[:limit])
+
+
+def candidate_ids(q):
+    """
+    The ids of the users matching `q`: those of the SEARCH_MAX_CANDIDATES
+    best matching first names, last names, emails and phone numbers.
+    """
+    limit = settings.SEARCH_MAX_CANDIDATES
+    ids = set()
+    for column in ('firstname', 'lastname'):
+        ids.update(_best_matches(User, column, q, limit))
+    for field_name, column in (('emails', 'email'),
+                               ('phonenumbers', 'number')):
+        field = User._meta.get_field(field_name)
+        contact_ids = _best_matches(field.related_model, column, q, limit)
+        ids.update(field.remote_field.through.objects.filter(**{
+            field.m2m_reverse_field_name() + '_id__in': contact_ids,
+        }).values_list('user_id', flat=True))
+    return ids
+
+
+def search_users(q):
+    """
+    Users matching `q`, best match first, annotated with `rank`: the score
+    of their best matching name, email or phone number.
+    """
+    score, zero = _scorer(q)
+    contacts = [Coalesce(Subquery(through.objects.filter(
+        user_id=OuterRef('id')).annotate(score=score(path)).order_by(
+        '-score').values('score')[:1]), zero)
+        for through, path in _contact_sources()]
+    rank = Greatest(score('firstname'), score('lastname'), *contacts)
+    return User.objects.filter(id__in=candidate_ids(q)).annotate(
+        rank=rank).order_by('-rank', 'id')
@@ -0,0 +1,44 @@
+import random
+import string
+
+from .serializers import CreateUserWithContactInfoSerializer
+
+FIRSTNAMES = ['John', 'Jane', 'Ali', 'Ayse', 'Mehmet', 'Anna', 'Lukas',
+              'Maria', 'Elif', 'Hans', 'Recep', 'Zeynep', 'Max', 'Emma']
+LASTNAMES = ['Doe', 'Roe', 'Yilmaz', 'Kaya', 'Demir', 'Muller', 'Schmidt',
+             'Fischer', 'Sirin', 'Weber', 'Celik', 'Wagner', 'Becker']
+
+
+def fake_user(rng=random):
+    """A synthetic user payload shaped like the POST /api/v1/users/ body."""
+    token = ''.join(rng.choices(string.ascii_lowercase + string.digits, k=12))
+    return {
+        "lastname": rng.choice(LASTNAMES),
+        "firstname": rng.choice(FIRSTNAMES),
+        "emails": ["%s.%d@example.com" % (token, i)
+                   for i in range(rng.randint(1, 3))],
+        "phonenumbers": ["+90 5%02d %03d %02d %02d" % (
+            rng.randint(0, 99), rng.randint(0, 999), rng.randint(0, 99),
+            rng.randint(0, 99)) for _ in range(rng.randint(1, 2))],
+    }
+
+
+def create_users(payloads):
+    """
+    Create the users of `payloads` through the bulk create path, validated
+    and so normalized like the API does, and return them.
+    """
+    bulk = CreateUserWithContactInfoSerializer(data=payloads, many=True)
+    bulk.is_valid(raise_exception=True)
+    return bulk.save()
+
+
+def seed_users(count, batch_size=5000, seed=None):
+    """Insert `count` synthetic users through the bulk create path."""
+    rng = random.Random(seed)
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        create_users([fake_user(rng) for _ in range(size)])
+        created += size
+        yield created
@@ -1,32 +1,173 @@
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
 from rest_framework import serializers
 
-from .models import User, PhoneNumber, Email
+from .cache import invalidate_users
+from .metrics import timed_representation
+from .models import (User, PhoneNumber, Email, Job, UserChange,
+                     contacts_by_user, delete_unlinked_contacts,
+                     ensure_contacts, lock_users, record_changes,
+                     refresh_contact_snapshots)
+from .normalization import normalize_email, normalize_phone
+
+
+class NormalizedEmailField(serializers.EmailField):
+
+    def to_internal_value(self, data):
+        return normalize_email(super().to_internal_value(data))
+
+
+class NormalizedPhoneNumberField(serializers.CharField):
+
+    def to_internal_value(self, data):
+        return normalize_phone(super().to_internal_value(data))
+
+
+class ContactListSerializer(serializers.ListSerializer):
+    """A list of normalized contact values, repeated values dropped."""
+
+    def to_internal_value(self, data):
+        return list(dict.fromkeys(super().to_internal_value(data)))
+
+
+def _link_contacts(field_name, value_field, user_values):
+    """
+    Link each `(user_id, values)` of `user_values` to the contacts holding
+    `values` through `User.<field_name>`, creating only the contacts that
+    are not stored yet and skipping links that already exist. Returns the
+    number of links created.
+    """
+    field = User._meta.get_field(field_name)
+    through, target = (field.remote_field.through,
+                       field.m2m_reverse_field_name())
+    ids = ensure_contacts(field.related_model, value_field,
+                          [value for _, values in user_values
+                           for value in values])
+    links = {(user_id, ids[value])
+             for user_id, values in user_values for value in values}
+    links -= set(through.objects.filter(**{
+        'user_id__in': {user_id for user_id, _ in user_values},
+        target + '_id__in': set(ids.values()),
+    }).values_list('user_id', target + '_id'))
+    # in the order of `user_values`, which is the order of the snapshots
+    through.objects.bulk_create(
+        [through(**{'user_id': user_id, target + '_id': ids[value]})
+         for user_id, values in user_values for value in values
+         if (user_id, ids[value]) in links],
+        ignore_conflicts=True)
+    return len(links)
+
+
+def _sync_contacts(user, field_name, value_field, values):
+    """
+    Make `user.<field_name>` hold exactly `values`, touching only the
+    difference: links to dropped values are deleted along with contacts no
+    longer referenced by any user, and only new values are linked. Returns
+    whether anything changed.
+    """
+    field = User._meta.get_field(field_name)
+    through, model = field.remote_field.through, field.related_model
+    target = field.m2m_reverse_field_name()
+    links = through.objects.filter(user_id=user.id).order_by('id')
+    missing = dict.fromkeys(values)
+    stale_links, stale_contacts = [], []
+    for link_id, contact_id, value in links.values_list(
+            'id', target + '_id', target + '__' + value_field):
+        if value in missing:
+            del missing[value]
+        else:
+            stale_links.append(link_id)
+            stale_contacts.append(contact_id)
+    if stale_links:
+        through.objects.filter(id__in=stale_links).delete()
+        delete_unlinked_contacts(model, stale_contacts)
+    if missing:
+        _link_contacts(field_name, value_field, [(user.id, list(missing))])
+    return bool(stale_links or missing)
+
+
+def _contacts_changed(user):
+    """Refresh the snapshot of `user` and tell the readers it changed."""
+    refresh_contact_snapshots([user.id])
+    record_changes([user.id], UserChange.UPDATED)
+    invalidate_users([user.id])
+
+
+def _create_users(validated_data, batch_size=1000):
+    """
+    Create the users of the `validated_data` payloads in one transaction,
+    with one multi-row INSERT per table and the contact snapshots written
+    along with the user rows.
+    """
+    with transaction.atomic():
+        email_ids = ensure_contacts(
+            Email, "email", [email for item in validated_data
+                             for email in item["emails"]],
+            batch_size=batch_size)
+        number_ids = ensure_contacts(
+            PhoneNumber, "number", [number for item in validated_data
+                                    for number in item["phonenumbers"]],
+            batch_size=batch_size)
+        users = [User(lastname=item["lastname"],
+                      firstname=item["firstname"],
+                      contacts={"emails": [[email_ids[email], email]
+                                           for email in item["emails"]],
+                                "phonenumbers": [
+                                    [number_ids[number], number]
+                                    for number in item["phonenumbers"]]})
+                 for item in validated_data]
+        User.objects.bulk_create(users, batch_size=batch_size)
+        User.emails.through.objects.bulk_create(
+            [User.emails.through(user_id=user.id, email_id=email_ids[email])
+             for user, item in zip(users, validated_data)
+             for email in item["emails"]],
+            batch_size=batch_size)
+        User.phonenumbers.through.objects.bulk_create(
+            [User.phonenumbers.through(phonenumber_id=number_ids[number],
+                                       user_id=user.id)
+             for user, item in zip(users, validated_data)
+             for number in item["phonenumbers"]],
+            batch_size=batch_size)
+        record_changes([user.id for user in users], UserChange.CREATED)
+    return users
+
+
+class BulkCreateUsersSerializer(serializers.ListSerializer):
+    batch_size = 1000
+
+    def create(self, validated_data):
+        return _create_users(validated_data, batch_size=self.batch_size)
+
+    @timed_representation
+    def to_representation(self, data):
+        # built from the validated payload, so no query per created user
+        return [{"id": user.id, **item}
+                for user, item in zip(data, self.validated_data)]
 
 
 class CreateUserWithContactInfoSerializer(serializers.Serializer):
     lastname = serializers.CharField(max_length=255)
     firstname = serializers.CharField(max_length=255)
-    emails = serializers.ListSerializer(child=serializers.EmailField())
-    phonenumbers = serializers.ListSerializer(child=serializers.CharField())
+    emails = ContactListSerializer(child=NormalizedEmailField())
+    phonenumbers = ContactListSerializer(child=NormalizedPhoneNumberField())
+
+    class Meta:
+        list_serializer_class = BulkCreateUsersSerializer
 
     def create(self, validated_data):
-        user = User.objects.create(lastname=validated_data["lastname"],
-                                   firstname=validated_data["firstname"])
-        for email in validated_data["emails"]:
-            email_obj = Email.objects.create(email=email)
-            user.emails.add(email_obj)
-        for number in validated_data["phonenumbers"]:
-            number_obj = PhoneNumber.objects.create(number=number)
-            user.phonenumbers.add(number_obj)
-        user.save()
+        user, = _create_users([validated_data])
         return user
 
+    @timed_representation
     def to_representation(self, instance):
         _repr = dict()
         _repr["lastname"] = instance.lastname
         _repr["firstname"] = instance.firstname
-        _repr["emails"] = [i.email for i in instance.emails.all()]
-        _repr["phonenumbers"] = [i.number for i in instance.phonenumbers.all()]
+        # in the order they were linked in, as the .all() order is undefined
+        emails, numbers = contacts_by_user([instance.id])
+        _repr["emails"] = emails[instance.id]
+        _repr["phonenumbers"] = numbers[instance.id]
         return _repr
 
 
@@ -37,55 +178,148 @@ class ListUsersSerializer(serializers.Serializer):
     emails = serializers.ListSerializer(child=serializers.EmailField())
     phonenumbers = serializers.ListSerializer(child=serializers.CharField())
 
+    @timed_representation
     def to_representation(self, instance):
         _repr = dict()
+        emails, numbers = instance.contact_pairs()
         _repr["id"] = instance.id
         _repr["lastname"] = instance.lastname
         _repr["firstname"] = instance.firstname
-        _repr["emails"] = [i.email for i in instance.emails.all()]
-        _repr["phonenumbers"] = [i.number for i in instance.phonenumbers.all()]
+        _repr["emails"] = [email for _, email in emails]
+        _repr["phonenumbers"] = [number for _, number in numbers]
         return _repr
 
 
+USER_FIELDS = ('id', 'lastname', 'firstname', 'emails', 'phonenumbers')
+CONTACT_FIELDS = ('emails', 'phonenumbers')
+
+
+def requested_fields(params):
+    """
+    The user fields asked for by `params`: `fields` lists any of USER_FIELDS
+    and `include` adds contact collections, to the names alone when there is
+    no `fields`. All of them when neither is given.
+    """
+    def parse(name, allowed):
+        values = {value for value in params[name].split(',') if value}
+        unknown = values - set(allowed)
+        if unknown:
+            raise serializers.ValidationError({
+                name: 'Unknown fields: %s.' % ', '.join(sorted(unknown))})
+        return values
+
+    if 'fields' not in params and 'include' not in params:
+        return USER_FIELDS
+    if 'fields' in params:
+        fields = parse('fields', USER_FIELDS)
+    else:
+        fields = set(USER_FIELDS) - set(CONTACT_FIELDS)
+    if 'include' in params:
+        fields |= parse('include', CONTACT_FIELDS)
+    return tuple(field for field in USER_FIELDS if field in fields)
+
+
+def user_rows(queryset, fields=USER_FIELDS):
+    """
+    `queryset` as `values()` rows ready for `serialize_user_rows`, which
+    skips building model instances for the list endpoints. Only the columns
+    `fields` need are selected.
+    """
+    columns = ['id'] + [field for field in ('lastname', 'firstname')
+                        if field in fields]
+    if settings.USER_CONTACT_SNAPSHOT_READS and any(
+            field in fields for field in CONTACT_FIELDS):
+        columns.append('contacts')
+    return queryset.values(*columns)
+
+
+@timed_representation
+def serialize_user_rows(rows, user_ids=None, fields=USER_FIELDS):
+    """
+    Turn `user_rows` dicts into the `ListUsersSerializer` representation in
+    place, restricted to `fields`. The contact collections of `fields` are
+    read from the snapshots, or else loaded in one query per collection
+    (for `user_ids`, the rows' ids by default).
+    """
+    collections = [field for field in CONTACT_FIELDS if field in fields]
+    missing = []
+    for row in rows:
+        snapshot = row.pop('contacts', None)
+        if not collections:
+            continue
+        if snapshot is None:
+            missing.append(row)
+        else:
+            for field in collections:
+                row[field] = [value for _, value in snapshot[field]]
+    if missing:
+        emails, numbers = contacts_by_user(
+            [row['id'] for row in missing] if user_ids is None else user_ids,
+            collections)
+        loaded = {'emails': emails, 'phonenumbers': numbers}
+        for row in missing:
+            for field in collections:
+                row[field] = loaded[field].get(row['id'], [])
+    if 'id' not in fields:
+        for row in rows:
+            del row['id']
+    return rows
+
+
 class AddAdditionalContactInfoSerializer(serializers.Serializer):
-    email = serializers.EmailField(max_length=1024)
-    phone_number = serializers.CharField(max_length=24)
+    email = NormalizedEmailField(max_length=1024)
+    phone_number = NormalizedPhoneNumberField(max_length=24)
 
     def update(self, instance, validated_data):
-        email = Email.objects.create(email=validated_data['email'])
-        instance.emails.add(email)
-        number = PhoneNumber.objects.create(
-            number=validated_data['phone_number'])
-        instance.phonenumbers.add(number)
+        with transaction.atomic():
+            lock_users([instance.id])
+            linked = [
+                _link_contacts("emails", "email",
+                               [(instance.id, [validated_data['email']])]),
+                _link_contacts("phonenumbers", "number",
+                               [(instance.id,
+                                 [validated_data['phone_number']])]),
+            ]
+            # re-adding known contacts must not look like a change to
+            # conditional GETs, the cache or the change feed
+            if any(linked):
+                _contacts_changed(instance)
         return instance
 
+    @timed_representation
     def to_representation(self, instance):
         _repr = dict()
-        _repr["emails"] = [i.email for i in instance.emails.all()]
-        _repr["phonenumbers"] = [i.number for i in instance.phonenumbers.all()]
+        # in the order they were linked in, as the .all() order is undefined
+        emails, numbers = contacts_by_user([instance.id])
+        _repr["emails"] = emails[instance.id]
+        _repr["phonenumbers"] = numbers[instance.id]
         return _repr
 
 
 class UpdateContactInfoSerializer(serializers.Serializer):
-    emails = serializers.ListSerializer(child=serializers.EmailField())
-    phonenumbers = serializers.ListSerializer(child=serializers.CharField())
+    emails = ContactListSerializer(child=NormalizedEmailField())
+    phonenumbers = ContactListSerializer(child=NormalizedPhoneNumberField())
 
     def update(self, instance, validated_data):
-        instance.emails.clear()
-        instance.phonenumbers.clear()
-        for email in validated_data["emails"]:
-            email_obj = Email.objects.create(email=email)
-            instance.emails.add(email_obj)
-        for number in validated_data["phonenumbers"]:
-            number_obj = PhoneNumber.objects.create(number=number)
-            instance.phonenumbers.add(number_obj)
-        instance.save()
+        with transaction.atomic():
+            lock_users([instance.id])
+            synced = [
+                _sync_contacts(instance, "emails", "email",
+                               validated_data["emails"]),
+                _sync_contacts(instance, "phonenumbers", "number",
+                               validated_data["phonenumbers"]),
+            ]
+            if any(synced):
+                _contacts_changed(instance)
         return instance
 
+    @timed_representation
     def to_representation(self, instance):
         _repr = dict()
-        _repr["emails"] = [i.email for i in instance.emails.all()]
-        _repr["phonenumbers"] = [i.number for i in instance.phonenumbers.all()]
+        # in the order they were linked in, as the .all() order is undefined
+        emails, numbers = contacts_by_user([instance.id])
+        _repr["emails"] = emails[instance.id]
+        _repr["phonenumbers"] = numbers[instance.id]
         return _repr
 
 
@@ -94,14 +328,15 @@ class DetailedUserSerializer(serializers.ModelSerializer):
         model = User
         fields = '__all__'
 
+    @timed_representation
     def to_representation(self, instance):
         _repr = dict()
+        emails, numbers = instance.contact_pairs()
         _repr["id"] = instance.id
         _repr["lastname"] = instance.lastname
         _repr["firstname"] = instance.firstname
-        _repr["emails"] = {i.id: i.email for i in instance.emails.all()}
-        _repr["phonenumbers"] = {i.id: i.number for i in
-                                 instance.phonenumbers.all()}
+        _repr["emails"] = dict(emails)
+        _repr["phonenumbers"] = dict(numbers)
         return _repr
 
 
@@ -119,3 +354,67 @@ class DetailedPhoneNumberContactSerializer(serializers.ModelSerializer):
 
 class UserDeleteSerializer(serializers.Serializer):
     id = serializers.IntegerField(min_value=1)
+
+
+class BulkUserDeleteSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1),
+                                required=False, max_length=100000)
+
+
+class UserBatchSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1),
+                                min_length=1, max_length=5000)
+
+
+class UserLookupSerializer(serializers.Serializer):
+    emails = serializers.ListField(child=serializers.CharField(),
+                                   required=False, max_length=1000)
+    phonenumbers = serializers.ListField(child=serializers.CharField(),
+                                         required=False, max_length=1000)
+
+    def validate(self, attrs):
+        if not attrs.get("emails") and not attrs.get("phonenumbers"):
+            raise serializers.ValidationError(
+                "At least one email or phone number is required.")
+        return attrs
+
+
+class UserSearchSerializer(serializers.Serializer):
+    # trigram indexes cannot narrow down shorter patterns
+    q = serializers.CharField(min_length=3, max_length=100)
+
+
+class ExportJobSerializer(serializers.Serializer):
+    # the filters of `[GET] /api/v1/users/export/`
+    id = serializers.IntegerField(min_value=1, required=False)
+    firstname = serializers.CharField(max_length=255, required=False)
+
+
+class JobSerializer(serializers.ModelSerializer):
+    # import: the first rejected rows, the others are only counted
+    errors_shown = 100
+
+    errors = serializers.SerializerMethodField()
+    result = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ('id', 'kind', 'status', 'partitions', 'done_partitions',
+                  'total', 'processed', 'failed_rows', 'error', 'errors',
+                  'result', 'created_at', 'started_at', 'finished_at')
+
+    def get_errors(self, job):
+        errors = []
+        if job.failed_rows:
+            for partition_errors in job.parts.exclude(
+                    status=Job.PENDING).order_by('number').values_list(
+                    'errors', flat=True).iterator():
+                errors += partition_errors[:self.errors_shown - len(errors)]
+                if len(errors) == self.errors_shown:
+                    break
+        return errors
+
+    def get_result(self, job):
+        if job.kind == Job.EXPORT and job.status == Job.DONE:
+            return reverse('job-result', kwargs={'id': job.id})
+        return None
@@ -1,11 +1,37 @@
-from django.test import TestCase
+import io
+import json
+import random
+import tempfile
+from datetime import timedelta
+from threading import Thread
+from unittest import mock, skipUnless
+
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.management.color import no_style
+from django.db import connection
+from django.test import (Client, RequestFactory, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
 from model_mommy import mommy
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
 from django.urls import reverse
 from rest_framework.test import APIClient
-from .models import User, Email, PhoneNumber
-from .serializers import CreateUserWithContactInfoSerializer
+from .models import (User, Email, Job, JobPartition, PhoneNumber,
+                     UserChange, contact_snapshots)
+from .normalization import normalize_phone
+from .renderers import FastJSONRenderer
+from .seeding import fake_user, seed_users
+from .serializers import (CreateUserWithContactInfoSerializer,
+                          ListUsersSerializer, serialize_user_rows,
+                          user_rows)
+from . import jobs, urls
+from .benchmarking import CommitCounter
+from .cache import get_user_detail, get_user_details, invalidate_users, stats
+from .db import check_connection_health
+from .middleware import metrics_view
+from .views import UserExportView
 
 
 class UserModelTest(TestCase):
@@ -27,6 +53,25 @@ class UserModelTest(TestCase):
         self.assertEqual(len(self.user.emails.all()), 0)
 
 
+class ConnectionHealthCheckTest(TestCase):
+
+    def _check(self, usable, enabled=True):
+        with mock.patch.dict(connection.settings_dict,
+                             {'CONN_HEALTH_CHECKS': enabled}), \
+                mock.patch.object(connection, 'is_usable',
+                                  return_value=usable), \
+                mock.patch.object(connection, 'close') as close:
+            check_connection_health()
+        return close
+
+    def test_unusable_connection_is_closed(self):
+        self._check(usable=False).assert_called_once_with()
+
+    def test_usable_or_unchecked_connection_is_kept(self):
+        self._check(usable=True).assert_not_called()
+        self._check(usable=False, enabled=False).assert_not_called()
+
+
 class CreateUserWithContactInfoSerializerTest(TestCase):
     def setUp(self):
         self.payload = {
@@ -76,13 +121,13 @@ class CreateUserWithContactInfoSerializerTest(TestCase):
         serializer.is_valid(True)
         serializer.save()
         _instance = User.objects.get(firstname="John")
+        # in link order, contact ids follow the (sorted) insertion order
+        contacts = contact_snapshots([_instance.id])[_instance.id]
 
         self.assertEqual(_instance.firstname, self.payload['firstname'])
         self.assertEqual(_instance.lastname, self.payload['lastname'])
-        self.assertEqual(_instance.emails.all()[0].email,
-                         self.payload['emails'][0])
-        self.assertEqual(_instance.phonenumbers.all()[0].number,
-                         self.payload['phonenumbers'][0])
+        self.assertEqual(contacts["emails"][0][1], self.payload['emails'][0])
+        self.assertEqual(contacts["phonenumbers"][0][1], "+905555555555")
 
 
 class BaseAPITest(TestCase):
@@ -90,12 +135,21 @@ class BaseAPITest(TestCase):
         self.client = APIClient()
 
     def setUp(self):
+        cache.clear()
         self._test_generate_users()
 
     def _test_generate_users(self):
         for i in range(1, 11):
-            mommy.make(User, id=i, emails=[mommy.make(Email)],
-                       phonenumbers=[mommy.make(PhoneNumber)])
+            mommy.make(User, id=i, firstname="First%d" % i,
+                       lastname="Last%d" % i, emails=[
+                mommy.make(Email, id=i, email="user%d@mail.com" % i)],
+                       phonenumbers=[mommy.make(PhoneNumber, id=i)])
+        # explicit ids don't advance the sequences on every backend
+        sequence_sql = connection.ops.sequence_reset_sql(
+            no_style(), [User, Email, PhoneNumber])
+        with connection.cursor() as cursor:
+            for sql in sequence_sql:
+                cursor.execute(sql)
 
 
 class UsersEndpointTest(BaseAPITest):
@@ -114,7 +168,8 @@ class UsersEndpointTest(BaseAPITest):
                                     format="json")
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(response.json(), self.payload)
+        self.assertEqual(response.json(), dict(
+            self.payload, phonenumbers=["+905555555555", "+495555555"]))
 
     def test_list_users(self):
         response = self.client.get(reverse('user'))
@@ -122,10 +177,50 @@ class UsersEndpointTest(BaseAPITest):
         self.assertIsInstance(response.json(), list)
         self.assertIsInstance(response.json()[0], dict)
 
+    def test_list_users_query_count_is_constant(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('user'))
+        queries_for_ten = len(ctx.captured_queries)
+
+        for _ in range(10):
+            mommy.make(User, emails=[mommy.make(Email), mommy.make(Email)],
+                       phonenumbers=[mommy.make(PhoneNumber)])
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('user'))
+        self.assertEqual(len(response.json()), 20)
+        self.assertEqual(len(ctx.captured_queries), queries_for_ten)
+
+    def test_list_users_keyset_pagination(self):
+        response = self.client.get(reverse('user'), {'limit': 4})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        page = response.json()
+        self.assertEqual([u['id'] for u in page['results']], [1, 2, 3, 4])
+        self.assertEqual(page['next'], 4)
+
+        response = self.client.get(reverse('user'),
+                                   {'after': 8, 'limit': 4})
+        page = response.json()
+        self.assertEqual([u['id'] for u in page['results']], [9, 10])
+        self.assertIsNone(page['next'])
+
+        response = self.client.get(reverse('user'), {'after': 'x'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_users_keyset_pagination_with_filter(self):
+        User.objects.filter(id__in=[2, 5, 7]).update(firstname="Jane")
+        response = self.client.get(reverse('user'), {'firstname': 'Jane',
+                                                     'after': 2, 'limit': 1})
+        page = response.json()
+        self.assertEqual([u['id'] for u in page['results']], [5])
+        self.assertEqual(page['next'], 5)
+
     def test_delete_user(self):
         response = self.client.delete(reverse('user'), {"id": 1},
                                       content_type="application/json")
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        # its contacts went with it
+        self.assertFalse(Email.objects.filter(id=1).exists())
+        self.assertFalse(PhoneNumber.objects.filter(id=1).exists())
 
         response = self.client.delete(reverse('user'), {"id": 2121},
                                       content_type="application/json",
@@ -133,6 +228,719 @@ class UsersEndpointTest(BaseAPITest):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
+class BulkUserEndpointTest(BaseAPITest):
+
+    def setUp(self):
+        super(BulkUserEndpointTest, self).setUp()
+        self.payload = [
+            {"lastname": "Doe", "firstname": "John",
+             "emails": ["john.doe@gmail.com", "noname@domain.com"],
+             "phonenumbers": ["+90 555 555 55 55"]},
+            {"lastname": "Roe", "firstname": "Jane",
+             "emails": ["jane.roe@gmail.com"],
+             "phonenumbers": ["+49 555 55 55", "+49 555 55 56"]},
+        ]
+
+    def _assert_created(self, response):
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = response.json()
+        self.assertEqual([{k: v for k, v in item.items() if k != 'id'}
+                          for item in created],
+                         [dict(item, phonenumbers=[
+                             normalize_phone(number)
+                             for number in item["phonenumbers"]])
+                          for item in self.payload])
+        for item in created:
+            user = User.objects.get(id=item['id'])
+            self.assertEqual([e.email for e in user.emails.all()],
+                             item['emails'])
+            self.assertEqual([p.number for p in user.phonenumbers.all()],
+                             item['phonenumbers'])
+
+    def test_bulk_create_users(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('bulk'), self.payload,
+                                        content_type="application/json")
+        self._assert_created(response)
+        queries_for_two = len(ctx.captured_queries)
+
+        self.payload = [{"lastname": "Doe", "firstname": "John",
+                         "emails": ["john%d@gmail.com" % i],
+                         "phonenumbers": ["+9055500%02d" % i]}
+                        for i in range(20)]
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('bulk'), self.payload,
+                             content_type="application/json")
+        self.assertEqual(len(ctx.captured_queries), queries_for_two)
+
+    def test_bulk_create_shares_contacts(self):
+        self.client.post(reverse('bulk'), self.payload,
+                         content_type="application/json")
+        self.payload[0]["emails"] = ["John.Doe@Gmail.com"]
+        self.payload[0]["phonenumbers"] = ["0090 555 555 55 55",
+                                           "+90-555-555-5555"]
+        response = self.client.post(reverse('bulk'), self.payload,
+                                    content_type="application/json")
+        self.assertEqual(response.json()[0]["emails"], ["john.doe@gmail.com"])
+        self.assertEqual(response.json()[0]["phonenumbers"], ["+905555555555"])
+        self.assertEqual(Email.objects.filter(
+            email="john.doe@gmail.com").get().user_set.count(), 2)
+        self.assertEqual(PhoneNumber.objects.count(), 10 + 3)
+
+    def test_bulk_create_users_from_ndjson(self):
+        body = "\n".join(json.dumps(item) for item in self.payload) + "\n"
+        response = self.client.post(reverse('bulk'), body,
+                                    content_type="application/x-ndjson")
+        self._assert_created(response)
+
+    def test_bulk_delete(self):
+        # user 2 shares email 1 with user 1, so it outlives the deletion
+        User.objects.get(id=2).emails.add(1)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.delete(reverse('bulk'), {"ids": [1, 3, 99]},
+                                          content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(),
+                         {"users": 2, "emails": 1, "phonenumbers": 2})
+        # the unlinked contacts of each table are locked, then deleted
+        self.assertLessEqual(len(ctx.captured_queries), 13)
+        self.assertEqual(list(User.objects.get(id=2).emails.values_list(
+            'id', flat=True).order_by('id')), [1, 2])
+        self.assertFalse(User.objects.filter(id__in=[1, 3]).exists())
+
+        User.objects.filter(id__in=[4, 5]).update(firstname="Jane")
+        response = self.client.delete(reverse('bulk') + '?firstname=Jane')
+        self.assertEqual(response.json()["users"], 2)
+        self.assertEqual(User.objects.count(), 6)
+
+    def test_bulk_delete_requires_ids_or_filter(self):
+        response = self.client.delete(reverse('bulk'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for params in ('?firstname=', '?lastname=&id='):
+            response = self.client.delete(reverse('bulk') + params)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(User.objects.count(), 10)
+
+    def test_bulk_create_is_all_or_nothing(self):
+        self.payload[1].pop("emails")
+        response = self.client.post(reverse('bulk'), self.payload,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()
+        self.assertEqual(errors[0], {})
+        self.assertIn("emails", errors[1])
+        self.assertEqual(User.objects.count(), 10)
+
+
+class ContactSnapshotTest(BaseAPITest):
+
+    def _assert_snapshots_match(self):
+        users = dict(User.objects.values_list('id', 'contacts'))
+        self.assertEqual(users, contact_snapshots(list(users)))
+
+    def test_write_paths_maintain_snapshot(self):
+        call_command('backfill_contact_snapshots', stdout=io.StringIO())
+        self._assert_snapshots_match()
+
+        self.client.post(reverse('user'), {
+            "lastname": "Doe", "firstname": "John",
+            "emails": ["john.doe@gmail.com"], "phonenumbers": ["+90 555"]},
+            content_type="application/json")
+        self.client.post(reverse('bulk'), [{
+            "lastname": "Roe", "firstname": "Jane",
+            "emails": ["jane.roe@gmail.com"], "phonenumbers": []}],
+            content_type="application/json")
+        self.client.post(reverse('contact', kwargs={'id': 1}), {
+            "email": "more@mail.com", "phone_number": "+90 556"},
+            content_type="application/json")
+        self.client.put(reverse('contact', kwargs={'id': 2}), {
+            "emails": ["new@mail.com"], "phonenumbers": []},
+            content_type="application/json")
+        self._assert_snapshots_match()
+
+    @override_settings(USER_CONTACT_SNAPSHOT_READS=True)
+    def test_reads_from_snapshot(self):
+        call_command('backfill_contact_snapshots', stdout=io.StringIO())
+        expected = self.client.get(reverse('contact', kwargs={'id': 3}))
+        cache.clear()
+        # the ETag aggregate and the rows
+        with self.assertNumQueries(2):
+            users = self.client.get(reverse('user')).json()
+        with self.assertNumQueries(1):
+            detail = self.client.get(reverse('contact', kwargs={'id': 3}))
+        self.assertEqual(detail.json(), expected.json())
+        self.assertEqual(users[2]['emails'],
+                         list(expected.json()['emails'].values()))
+
+    def test_check_command(self):
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('check_contact_snapshots', stdout=out)
+        get_user_detail(1, lambda: {"stale": True})
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('check_contact_snapshots', fix=True, stdout=out)
+        call_command('check_contact_snapshots', stdout=out)
+        self.assertIn('All snapshots match.', out.getvalue())
+        # readers learn about the repair
+        self.assertEqual(get_user_detail(1, lambda: {"fresh": True}),
+                         {"fresh": True})
+        self.assertEqual(set(UserChange.objects.filter(
+            kind=UserChange.UPDATED).values_list('user_id', flat=True)),
+            set(User.objects.values_list('id', flat=True)))
+
+
+class DedupeContactsCommandTest(BaseAPITest):
+
+    def test_merges_duplicates_and_deletes_unreferenced(self):
+        # stored before normalization, so not caught by the unique index
+        User.objects.get(id=2).emails.add(
+            Email.objects.create(email="User1@Mail.com"))
+        User.objects.get(id=3).phonenumbers.add(
+            PhoneNumber.objects.create(number="+90 555"),
+            PhoneNumber.objects.create(number="0090555"))
+        Email.objects.create(email="orphan@mail.com")
+
+        out = io.StringIO()
+        call_command('dedupe_contacts', stdout=out)
+        self.assertIn('2 duplicate contacts merged, 1 unreferenced contacts '
+                      'deleted, 2 users updated', out.getvalue())
+        email = Email.objects.get(email="user1@mail.com")
+        self.assertEqual(email.id, 1)
+        self.assertEqual(sorted(email.user_set.values_list('id', flat=True)),
+                         [1, 2])
+        numbers = User.objects.get(id=3).phonenumbers.values_list(
+            'number', flat=True)
+        self.assertEqual(len(numbers), 2)
+        self.assertIn("+90555", numbers)
+        self.assertFalse(Email.objects.filter(
+            email="orphan@mail.com").exists())
+        for user in User.objects.filter(id__in=[2, 3]):
+            self.assertEqual(user.contacts,
+                             contact_snapshots([user.id])[user.id])
+
+
+class LeanRenderingTest(BaseAPITest):
+
+    def test_lean_rows_match_list_serializer(self):
+        qs = User.objects.order_by('id')
+        self.assertEqual(
+            serialize_user_rows(list(user_rows(qs))),
+            [dict(item) for item in ListUsersSerializer(qs, many=True).data])
+
+    def test_renderer_without_orjson(self):
+        data = {"id": 1, "emails": {2: "a@b.com"}, "name": "Ça"}
+        rendered = FastJSONRenderer().render(data)
+        with mock.patch('api.renderers.orjson', None):
+            fallback = FastJSONRenderer().render(data)
+        self.assertEqual(json.loads(rendered), json.loads(fallback))
+        self.assertEqual(json.loads(fallback),
+                         {"id": 1, "emails": {"2": "a@b.com"}, "name": "Ça"})
+
+
+class BenchmarkCommandTest(TransactionTestCase):
+    # writes commit as in a real run, so that the cache is invalidated
+
+    def setUp(self):
+        # ids are reused across tests, cached payloads must not be
+        cache.clear()
+
+    def test_benchmark_covers_every_route(self):
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+            call_command('benchmark', seed=30, requests=3,
+                         use_existing_db=True, output=output.name,
+                         trace_memory=True, stderr=io.StringIO())
+            results = json.load(output)
+        self.assertEqual({r['route'] for r in results.values()},
+                         {p.name for p in urls.urlpatterns})
+        for result in results.values():
+            self.assertEqual(result['errors'], 0)
+            self.assertEqual(result['requests'], 3)
+            self.assertGreater(result['peak_alloc_kb'], 0)
+
+    def test_benchmark_fails_on_regression(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as baseline:
+            json.dump({'contact detail': {'queries_per_request': 0,
+                                          'p95_ms': 1000}}, baseline)
+            baseline.flush()
+            with self.assertRaisesMessage(CommandError, 'contact detail'):
+                call_command('benchmark', seed=10, requests=2,
+                             only=['contact detail'], use_existing_db=True,
+                             baseline=baseline.name, stdout=io.StringIO(),
+                             stderr=io.StringIO())
+
+
+class LoadUsersCommandTest(BaseAPITest):
+
+    def _load(self, content, suffix, **options):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix) as f:
+            f.write(content)
+            f.flush()
+            out = io.StringIO()
+            call_command('load_users', f.name, stdout=out,
+                         stderr=io.StringIO(), **options)
+        return out.getvalue()
+
+    def test_load_ndjson(self):
+        out = self._load(
+            json.dumps({"lastname": "Doe", "firstname": "Loaded",
+                        "emails": ["User1@Mail.com", "loaded@load.test"],
+                        "phonenumbers": ["+90 (555) 000-00-01"]}) + '\n\n' +
+            json.dumps({"lastname": "Roe", "firstname": "Loaded",
+                        "emails": [], "phonenumbers": []}) + '\n',
+            '.ndjson', batch_size=1)
+        self.assertIn('2 users loaded', out)
+        self.assertIn('rows/sec', out)
+        doe, roe = User.objects.filter(firstname="Loaded").order_by('id')
+        # shares the existing contact, snapshot included
+        self.assertEqual(doe.contacts, contact_snapshots([doe.id])[doe.id])
+        self.assertEqual([email for _, email in doe.contacts["emails"]],
+                         ["user1@mail.com", "loaded@load.test"])
+        self.assertEqual(doe.contacts["emails"][0][0], 1)
+        self.assertEqual(doe.contacts["phonenumbers"][0][1],
+                         normalize_phone("+90 (555) 000-00-01"))
+        self.assertEqual(roe.contacts, {"emails": [], "phonenumbers": []})
+        self.assertEqual(set(UserChange.objects.filter(
+            kind=UserChange.CREATED).values_list('user_id', flat=True)),
+            {doe.id, roe.id})
+        # the API reads what was loaded
+        response = self.client.get(reverse('contact', kwargs={'id': doe.id}))
+        self.assertEqual(response.json()["emails"], {
+            str(i): email for i, email in doe.contacts["emails"]})
+
+    def test_load_csv(self):
+        self._load('lastname,firstname,emails,phonenumbers\n'
+                   'Doe,"Loaded, Jr",a@load.test;b@load.test,\n',
+                   '.csv')
+        user = User.objects.get(firstname="Loaded, Jr")
+        self.assertEqual(list(user.emails.order_by('email').values_list(
+            'email', flat=True)), ["a@load.test", "b@load.test"])
+        self.assertFalse(user.phonenumbers.exists())
+
+    def test_generate_dataset(self):
+        with tempfile.NamedTemporaryFile('r', suffix='.csv') as f:
+            call_command('load_users', generate=5, seed=1, write=f.name,
+                         stdout=io.StringIO())
+            self.assertEqual(len(f.read().splitlines()), 6)
+            self.assertEqual(User.objects.count(), 10)
+            call_command('load_users', f.name, generate=3, seed=2,
+                         stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(User.objects.count(), 18)
+        with self.assertRaises(CommandError):
+            call_command('load_users')
+
+
+class UserExportEndpointTest(BaseAPITest):
+
+    def _export(self, **params):
+        response = self.client.get(reverse('export'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        body = b''.join(response.streaming_content).decode()
+        return [json.loads(line) for line in body.splitlines()]
+
+    def test_export_users_as_ndjson(self):
+        with mock.patch.object(UserExportView, 'chunk_size', 3):
+            users = self._export()
+        self.assertEqual([u['id'] for u in users], list(range(1, 11)))
+        user = User.objects.get(id=1)
+        self.assertEqual(users[0]['emails'], [user.emails.all()[0].email])
+        self.assertEqual(users[0]['phonenumbers'],
+                         [user.phonenumbers.all()[0].number])
+
+    def test_export_users_with_filter(self):
+        users = self._export(id=4)
+        self.assertEqual([u['id'] for u in users], [4])
+
+
+@override_settings(JOB_IMPORT_PARTITION_SIZE=2, JOB_EXPORT_PARTITION_SIZE=4)
+class JobTest(BaseAPITest):
+
+    def _import(self, rows):
+        response = self.client.post(reverse('job-import'), rows,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response['Location'],
+                         reverse('job', kwargs={'id': response.json()['id']}))
+        return response.json()['id']
+
+    def _status(self, job_id):
+        return self.client.get(reverse('job', kwargs={'id': job_id})).json()
+
+    def test_import_job(self):
+        job_id = self._import([
+            {"lastname": "Doe", "firstname": "John",
+             "emails": ["john@jobs.test"], "phonenumbers": ["+905551112233"]},
+            {"lastname": "Doe", "firstname": "Jane", "emails": ["nope"],
+             "phonenumbers": []},
+            {"lastname": "Roe", "firstname": "Jim",
+             "emails": ["jim@jobs.test"], "phonenumbers": []},
+        ])
+        self.assertEqual(self._status(job_id)['status'], Job.PENDING)
+        self.assertEqual(jobs.work(once=True), 2)
+        job = self._status(job_id)
+        self.assertEqual((job['status'], job['partitions'],
+                          job['done_partitions'], job['total'],
+                          job['processed'], job['failed_rows']),
+                         (Job.DONE, 2, 2, 3, 2, 1))
+        self.assertEqual([error['row'] for error in job['errors']], [1])
+        self.assertIn('emails', job['errors'][0]['errors'])
+        self.assertIsNone(job['result'])
+        john = User.objects.get(firstname="John", lastname="Doe")
+        self.assertEqual(contact_snapshots([john.id])[john.id]['emails'],
+                         [[john.emails.get().id, "john@jobs.test"]])
+        self.assertTrue(User.objects.filter(firstname="Jim").exists())
+
+    def test_export_job(self):
+        response = self.client.post(
+            reverse('job-export') + '?fields=id,firstname,emails')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = response.json()['id']
+        result = reverse('job-result', kwargs={'id': job_id})
+        self.assertEqual(self.client.get(result).status_code,
+                         status.HTTP_409_CONFLICT)
+        self.assertEqual(jobs.work(once=True), 3)
+        job = self._status(job_id)
+        self.assertEqual((job['status'], job['processed'], job['result']),
+                         (Job.DONE, 10, result))
+        response = self.client.get(result)
+        self.assertEqual(
+            b''.join(response.streaming_content),
+            b''.join(self.client.get(reverse('export'), {
+                'fields': 'id,firstname,emails'}).streaming_content))
+
+    def test_export_job_with_filter(self):
+        response = self.client.post(reverse('job-export') + '?firstname=x')
+        job = response.json()
+        self.assertEqual((job['status'], job['partitions']), (Job.DONE, 0))
+        response = self.client.post(reverse('job-export') + '?id=x')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_partition_of_a_lost_worker_is_run_again(self):
+        job_id = self._import([
+            {"lastname": "Doe", "firstname": "Lost%d" % i,
+             "emails": [], "phonenumbers": []} for i in range(4)])
+        # a worker claims the first partition and is killed
+        lost = jobs.claim_partition()
+        self.assertEqual(jobs.work(once=True), 1)
+        self.assertEqual(self._status(job_id)['status'], Job.RUNNING)
+        with override_settings(JOB_LEASE_SECONDS=0):
+            self.assertEqual(jobs.work(once=True), 1)
+        self.assertEqual(self._status(job_id)['status'], Job.DONE)
+        # and if it was only slow, its late run is discarded
+        jobs.run_partition(lost)
+        self.assertEqual(User.objects.filter(
+            firstname__startswith="Lost").count(), 4)
+
+    def test_failing_partition_fails_the_job(self):
+        job_id = self._import([{"lastname": "Doe", "firstname": "John",
+                                "emails": [], "phonenumbers": []}] * 3)
+
+        def fail(job, partition):
+            raise RuntimeError("boom")
+        with mock.patch.dict(jobs.RUNNERS, {Job.IMPORT: fail}):
+            jobs.work(once=True)
+        job = self._status(job_id)
+        self.assertEqual(job['status'], Job.FAILED)
+        self.assertIn("boom", job['error'])
+        self.assertEqual(JobPartition.objects.get(
+            job_id=job_id, number=0).attempts, 3)
+        self.assertFalse(User.objects.filter(firstname="John").exists())
+
+    def test_unknown_job(self):
+        self.assertEqual(self.client.get(reverse(
+            'job', kwargs={'id': 999})).status_code,
+            status.HTTP_404_NOT_FOUND)
+        response = self.client.post(reverse('job-import'), {"a": 1},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SparseFieldsetTest(BaseAPITest):
+
+    def _list(self, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('user'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # the first query computes the ETag
+        return response.json(), [query['sql'] for query
+                                 in ctx.captured_queries[1:]]
+
+    def test_names_only_skip_contacts(self):
+        users, queries = self._list(fields='id,firstname', limit=2)
+        self.assertEqual(users['results'][0].keys(), {'id', 'firstname'})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('lastname', queries[0])
+        self.assertNotIn('JOIN', queries[0])
+
+    def test_include_one_collection(self):
+        users, queries = self._list(include='emails')
+        self.assertEqual(users[0], {"id": 1, "lastname": users[0]["lastname"],
+                                    "firstname": users[0]["firstname"],
+                                    "emails": ["user1@mail.com"]})
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('phonenumber', queries[1])
+
+        users, _ = self._list(fields='firstname', include='phonenumbers')
+        self.assertEqual(users[0].keys(), {'firstname', 'phonenumbers'})
+
+    @override_settings(USER_CONTACT_SNAPSHOT_READS=True)
+    def test_snapshot_column_skipped(self):
+        call_command('backfill_contact_snapshots', stdout=io.StringIO())
+        _, queries = self._list(fields='id,lastname')
+        self.assertNotIn('contacts', queries[0])
+        users, queries = self._list(include='phonenumbers', fields='id')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(users[0]['phonenumbers'],
+                         [User.objects.get(id=1).phonenumbers.get().number])
+
+    def test_detail_and_export_fields(self):
+        response = self.client.get(reverse('contact', kwargs={'id': 1}),
+                                   {'fields': 'id,emails'})
+        self.assertEqual(response.json(),
+                         {"id": 1, "emails": {"1": "user1@mail.com"}})
+        response = self.client.get(reverse('export'), {'fields': 'id'})
+        self.assertEqual(
+            [json.loads(line) for line in b''.join(
+                response.streaming_content).splitlines()][:2],
+            [{"id": 1}, {"id": 2}])
+
+    def test_unknown_fields(self):
+        response = self.client.get(reverse('user'), {'fields': 'id,password'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(),
+                         {'fields': 'Unknown fields: password.'})
+        response = self.client.get(reverse('user'), {'include': 'firstname'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UserChangeFeedTest(BaseAPITest):
+
+    def _changes(self, after=0, **params):
+        return self.client.get(reverse('changes'),
+                               dict(params, after=after)).json()
+
+    # sequences are not reset between tests, so the log starts with a gap
+    @override_settings(USER_CHANGES_SETTLE_SECONDS=0)
+    def test_feed_reports_creates_updates_and_deletes(self):
+        self.client.post(reverse('bulk'), [
+            {"lastname": "Doe", "firstname": "John", "emails": [],
+             "phonenumbers": []}] * 2, content_type="application/json")
+        feed = self._changes()
+        self.assertFalse(feed['more'])
+        created = [change['id'] for change in feed['results']]
+        self.assertEqual([change['change'] for change in feed['results']],
+                         ['created', 'created'])
+        self.assertEqual(feed['results'][0]['user']['firstname'], "John")
+
+        cursor = feed['cursor']
+        self.assertEqual(self._changes(cursor),
+                         {'cursor': cursor, 'more': False, 'results': []})
+        self.client.put(reverse('contact', kwargs={'id': created[0]}),
+                        {"emails": ["john@mail.com"], "phonenumbers": []},
+                        content_type="application/json")
+        self.client.post(reverse('contact', kwargs={'id': created[0]}),
+                         {"email": "doe@mail.com", "phone_number": "+90555"},
+                         content_type="application/json")
+        self.client.delete(reverse('user'), {"id": created[1]},
+                           content_type="application/json")
+        feed = self._changes(cursor)
+        self.assertEqual([(change['id'], change['change'])
+                          for change in feed['results']],
+                         [(created[0], 'updated'), (created[1], 'deleted')])
+        self.assertEqual(feed['results'][0]['user']['emails'],
+                         ["john@mail.com", "doe@mail.com"])
+        self.assertIsNone(feed['results'][1]['user'])
+
+        feed = self._changes(cursor, limit=1)
+        self.assertTrue(feed['more'])
+        self.assertEqual(len(feed['results']), 1)
+
+    def test_no_op_writes_are_not_changes(self):
+        url = reverse('contact', kwargs={'id': 1})
+        user = self.client.get(url).json()
+        number = list(user["phonenumbers"].values())[0]
+        before = UserChange.objects.count()
+        self.client.put(url, {"emails": ["user1@mail.com"],
+                              "phonenumbers": [number]},
+                        content_type="application/json")
+        self.client.post(url, {"email": "USER1@mail.com",
+                               "phone_number": number},
+                         content_type="application/json")
+        self.assertEqual(UserChange.objects.count(), before)
+
+    def test_feed_waits_for_uncommitted_changes(self):
+        first, _, third = UserChange.objects.bulk_create(
+            [UserChange(user_id=1, kind=UserChange.CREATED) for _ in range(3)])
+        # the cursor value in between is held by a transaction in progress
+        UserChange.objects.filter(id=first.id + 1).delete()
+        self.assertEqual(self._changes(first.id - 1)['cursor'], first.id)
+        UserChange.objects.filter(id=third.id).update(
+            at=third.at - timedelta(seconds=60))
+        self.assertEqual(self._changes(first.id - 1)['cursor'], third.id)
+
+
+class UserLookupEndpointTest(BaseAPITest):
+
+    def setUp(self):
+        super(UserLookupEndpointTest, self).setUp()
+        self.client.post(reverse('bulk'), [
+            {"lastname": "Doe", "firstname": "John",
+             "emails": ["John.Doe@Gmail.com"],
+             "phonenumbers": ["+90 (555) 555-55-55"]},
+            {"lastname": "Doe", "firstname": "Jane",
+             "emails": ["jane.doe@gmail.com"],
+             "phonenumbers": ["0090 555 555 55 55"]},
+        ], content_type="application/json")
+        self.john, self.jane = User.objects.filter(
+            lastname="Doe").order_by('id')
+
+    def test_lookup_by_email_and_phone(self):
+        response = self.client.get(reverse('lookup'), {
+            'email': ['john.doe@gmail.com', 'nobody@gmail.com'],
+            'phone': '+905555555555'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {
+            "emails": {"john.doe@gmail.com": [self.john.id],
+                       "nobody@gmail.com": []},
+            "phonenumbers": {"+905555555555": [self.john.id, self.jane.id]},
+        })
+
+    def test_batch_lookup(self):
+        response = self.client.post(reverse('lookup'), {
+            "emails": ["JANE.DOE@gmail.com", "John.Doe@Gmail.com"],
+        }, content_type="application/json")
+        self.assertEqual(response.json(), {
+            "emails": {"JANE.DOE@gmail.com": [self.jane.id],
+                       "John.Doe@Gmail.com": [self.john.id]},
+            "phonenumbers": {},
+        })
+
+    def test_lookup_finds_seeded_users(self):
+        list(seed_users(3, seed=0))
+        payload = fake_user(random.Random(0))
+        response = self.client.get(reverse('lookup'), {
+            'email': payload['emails'][0],
+            'phone': payload['phonenumbers'][0]})
+        user = User.objects.get(emails__email=payload['emails'][0])
+        self.assertEqual(response.json(), {
+            "emails": {payload['emails'][0]: [user.id]},
+            "phonenumbers": {payload['phonenumbers'][0]: [user.id]},
+        })
+
+    def test_lookup_requires_a_value(self):
+        response = self.client.get(reverse('lookup'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UserBatchEndpointTest(BaseAPITest):
+
+    def test_batch_in_request_order(self):
+        response = self.client.get(reverse('batch'), {'ids': '3,99,1,3'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user["id"] for user in response.json()["results"]],
+                         [3, 1])
+        self.assertEqual(response.json()["missing"], [99])
+        self.assertEqual(response.json()["results"][1],
+                         self.client.get(reverse(
+                             'contact', kwargs={'id': 1})).json())
+
+    def test_batch_post_with_fields(self):
+        response = self.client.post(
+            reverse('batch') + '?fields=id,emails', {"ids": [2, 1]},
+            content_type="application/json")
+        self.assertEqual(response.json(), {"results": [
+            {"id": 2, "emails": {"2": "user2@mail.com"}},
+            {"id": 1, "emails": {"1": "user1@mail.com"}},
+        ], "missing": []})
+
+    def test_batch_queries_do_not_grow_with_ids(self):
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse('batch'), {'ids': '1,2'})
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(reverse('batch'),
+                            {'ids': ','.join(map(str, range(3, 11)))})
+        self.assertLessEqual(len(many), 3)
+        self.assertEqual(len(few), len(many))
+        # all cached now
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('batch'), {'ids': '10,1'})
+        self.assertEqual(len(response.json()["results"]), 2)
+
+    def test_batch_requires_ids(self):
+        for params in ({}, {'ids': '1,x'}, {'ids': '0'}):
+            response = self.client.get(reverse('batch'), params)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class UserSearchTest(BaseAPITest):
+
+    def setUp(self):
+        super(UserSearchTest, self).setUp()
+        self.client.post(reverse('bulk'), [
+            {"lastname": "Marlow", "firstname": "Philip",
+             "emails": ["pm@search.test"], "phonenumbers": ["+15550001"]},
+            {"lastname": "Phillips", "firstname": "Ann",
+             "emails": ["ann@search.test"], "phonenumbers": ["+15550002"]},
+            {"lastname": "Lee", "firstname": "Bo",
+             "emails": ["philately@search.test"],
+             "phonenumbers": ["+15550003"]},
+        ], content_type="application/json")
+        self.philip, self.ann, self.bo = User.objects.filter(
+            lastname__in=["Marlow", "Phillips", "Lee"]).order_by('id')
+
+    def test_search_ranks_name_matches_first(self):
+        response = self.client.get(reverse('user'), {'q': 'phil'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['next'], None)
+        self.assertEqual([user['id'] for user in response.json()['results']],
+                         [self.philip.id, self.ann.id, self.bo.id])
+        self.assertEqual(response.json()['results'][0], {
+            "id": self.philip.id, "lastname": "Marlow", "firstname": "Philip",
+            "emails": ["pm@search.test"], "phonenumbers": ["+15550001"]})
+
+    def test_search_contacts_and_paginate(self):
+        response = self.client.get(reverse('user'), {'q': '5550002'})
+        self.assertEqual([user['id'] for user in response.json()['results']],
+                         [self.ann.id])
+        response = self.client.get(reverse('user'), {'q': 'search.test',
+                                                     'limit': 2})
+        self.assertEqual(response.json()['next'], 2)
+        response = self.client.get(reverse('user'), {'q': 'search.test',
+                                                     'limit': 2, 'offset': 2})
+        self.assertEqual(response.json()['next'], None)
+        self.assertEqual(len(response.json()['results']), 1)
+
+    @override_settings(SEARCH_MAX_CANDIDATES=2)
+    def test_search_keeps_the_best_candidates(self):
+        self.client.post(reverse('bulk'), [
+            {"lastname": "Rank", "firstname": firstname, "emails": [],
+             "phonenumbers": []}
+            for firstname in ("Johnathan", "Johnny", "John")
+        ], content_type="application/json")
+        response = self.client.get(reverse('user'), {'q': 'john'})
+        self.assertEqual([user['firstname']
+                          for user in response.json()['results']][:1],
+                         ["John"])
+
+    def test_search_ranks_contact_matches(self):
+        self.client.post(reverse('bulk'), [
+            {"lastname": "mail@rank.testing", "firstname": "Partial",
+             "emails": [], "phonenumbers": []},
+            {"lastname": "Exact", "firstname": "Email",
+             "emails": ["mail@rank.test"], "phonenumbers": []},
+        ], content_type="application/json")
+        response = self.client.get(reverse('user'), {'q': 'mail@rank.test'})
+        self.assertEqual([user['firstname']
+                          for user in response.json()['results']],
+                         ["Email", "Partial"])
+
+    def test_search_requires_three_characters(self):
+        response = self.client.get(reverse('user'), {'q': 'ph'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
 class ContactInfoEndpointTest(BaseAPITest):
 
     def setUp(self):
@@ -166,7 +974,7 @@ class ContactInfoEndpointTest(BaseAPITest):
         returned_data = response.json()
         self.assertEqual(returned_data['emails'][-1], self.payload['email'])
         self.assertEqual(returned_data['phonenumbers'][-1],
-                         self.payload['phone_number'])
+                         normalize_phone(self.payload['phone_number']))
 
     def test_list_specific_users_contact_info(self):
         # api/v1/users/1/contact
@@ -193,7 +1001,423 @@ class ContactInfoEndpointTest(BaseAPITest):
                                    will_be_updated, format='json',
                                    content_type="application/json")
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(will_be_updated, response.json())
+        self.assertEqual(
+            dict(will_be_updated, phonenumbers=["+9005557772211"]),
+            response.json())
+        # the replaced contacts are not left behind
+        self.assertEqual(Email.objects.count(), 11)
+        self.assertEqual(PhoneNumber.objects.count(), 10)
+
+    def test_update_users_contact_info_diff(self):
+        user = User.objects.get(id=1)
+        kept_email = user.emails.get().email
+        payload = {"emails": [kept_email, "new@mail.com"],
+                   "phonenumbers": ["+9005557772211"]}
+        self.client.put(reverse('contact', kwargs={'id': 1}), payload,
+                        content_type="application/json")
+        self.assertTrue(user.emails.filter(id=1).exists())
+        self.assertEqual(sorted(e.email for e in user.emails.all()),
+                         sorted(payload["emails"]))
+
+        def no_op_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.put(
+                    reverse('contact', kwargs={'id': 1}), payload,
+                    content_type="application/json")
+            self.assertEqual(response.json(), payload)
+            return len(ctx.captured_queries)
+
+        queries = no_op_queries()
+        payload["emails"] += ["more%d@mail.com" % i for i in range(5)]
+        self.client.put(reverse('contact', kwargs={'id': 1}), payload,
+                        content_type="application/json")
+        self.assertEqual(no_op_queries(), queries)
+        self.assertEqual(user.emails.count(), 7)
+
+
+class ConditionalGetTest(BaseAPITest):
+
+    def test_detail_not_modified_until_contacts_change(self):
+        url = reverse('contact', kwargs={'id': 1})
+        response = self.client.get(url)
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+        response = self.client.get(
+            reverse('email', kwargs={'id': 1, 'pk': 1}),
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {"email": "new@mail.com",
+                                   "phone_number": "+90555"},
+                             content_type="application/json")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_detail_not_modified_by_a_no_op_write(self):
+        url = reverse('contact', kwargs={'id': 1})
+        user = self.client.get(url)
+        etag = user.headers['ETag']
+        writes = (
+            ('put', {"emails": list(user.json()["emails"].values()),
+                     "phonenumbers": list(
+                         user.json()["phonenumbers"].values())}),
+            ('post', {"email": "user1@mail.com",
+                      "phone_number": list(
+                          user.json()["phonenumbers"].values())[0]}),
+        )
+        for method, data in writes:
+            with self.captureOnCommitCallbacks(execute=True), \
+                    CaptureQueriesContext(connection) as ctx:
+                response = getattr(self.client, method)(
+                    url, data, content_type="application/json")
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual([query['sql'] for query in ctx.captured_queries
+                              if query['sql'].startswith(
+                                  ('INSERT', 'UPDATE', 'DELETE'))], [])
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+
+    def test_list_etag_follows_any_write(self):
+        etag = self.client.get(reverse('user')).headers['ETag']
+        # a writer that stamped before the latest one but committed after it
+        latest = User.objects.order_by('-updated_at').first()
+        User.objects.exclude(id=latest.id).filter(id=5).update(
+            updated_at=latest.updated_at - timedelta(microseconds=1))
+        response = self.client.get(reverse('user'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_list_not_modified_until_users_change(self):
+        response = self.client.get(reverse('user'), {'limit': 3})
+        etag = response.headers['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('user'), {'limit': 3},
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # a user of the page gets deleted, the next one moves in
+        self.client.delete(reverse('user'), {"id": 2},
+                           content_type="application/json")
+        response = self.client.get(reverse('user'), {'limit': 3},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers['ETag']
+
+        self.client.put(reverse('contact', kwargs={'id': 3}),
+                        {"emails": ["new@mail.com"], "phonenumbers": []},
+                        content_type="application/json")
+        response = self.client.get(reverse('user'), {'limit': 3},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class SingleStatementReadTest(BaseAPITest):
+
+    def setUp(self):
+        super(SingleStatementReadTest, self).setUp()
+        User.objects.get(id=1).emails.add(2)
+        User.objects.get(id=1).phonenumbers.add(3)
+
+    def test_detail_in_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('contact', kwargs={'id': 1}))
+        user = User.objects.get(id=1)
+        self.assertEqual(response.json(), {
+            "id": 1, "lastname": user.lastname, "firstname": user.firstname,
+            "emails": {"1": "user1@mail.com", "2": "user2@mail.com"},
+            "phonenumbers": {str(number.id): number.number
+                             for number in user.phonenumbers.all()}})
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('contact', kwargs={'id': 99}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_contact_in_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse('email', kwargs={'id': 1, 'pk': 2}))
+        self.assertEqual(response.json(), {"email": "user2@mail.com"})
+        self.assertIn('ETag', response.headers)
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse('number', kwargs={'id': 1, 'pk': 3}))
+        self.assertEqual(response.json(), {
+            "number": PhoneNumber.objects.get(id=3).number})
+        # user 3 does not have email 2
+        response = self.client.get(reverse('email', kwargs={'id': 3, 'pk': 2}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AtomicWriteTest(BaseAPITest):
+    payload = {"lastname": "Doe", "firstname": "Atomic",
+               "emails": ["atomic@write.test"],
+               "phonenumbers": ["+905550001122"]}
+
+    def test_failed_create_leaves_nothing(self):
+        with mock.patch('api.serializers.record_changes',
+                        side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('user'), self.payload,
+                                 content_type="application/json")
+        self.assertFalse(User.objects.filter(firstname="Atomic").exists())
+        self.assertFalse(Email.objects.filter(
+            email="atomic@write.test").exists())
+
+    def test_failed_contact_update_leaves_nothing(self):
+        with mock.patch('api.serializers.record_changes',
+                        side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('contact', kwargs={'id': 1}), {
+                    "email": "atomic@write.test",
+                    "phone_number": "+905550001122"},
+                    content_type="application/json")
+        self.assertEqual(list(User.objects.get(id=1).emails.values_list(
+            'email', flat=True)), ["user1@mail.com"])
+        self.assertFalse(Email.objects.filter(
+            email="atomic@write.test").exists())
+
+
+class ConcurrentWriteTest(TransactionTestCase):
+    # writers commit, as they would outside of tests
+
+    def setUp(self):
+        cache.clear()
+
+    def _create(self, client, firstname, emails, phonenumbers):
+        response = client.post(reverse('user'), {
+            "lastname": "Concurrent", "firstname": firstname,
+            "emails": emails, "phonenumbers": phonenumbers,
+        }, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_one_commit_per_write(self):
+        with CommitCounter(connection) as counter:
+            self._create(self.client, "One", ["one@concurrent.test"],
+                         ["+905550000001"])
+        self.assertEqual(counter.commits, 1)
+        user = User.objects.get(firstname="One")
+        for method, data in (
+                ('post', {"email": "two@concurrent.test",
+                          "phone_number": "+905550000002"}),
+                ('put', {"emails": ["three@concurrent.test"],
+                         "phonenumbers": []})):
+            with CommitCounter(connection) as counter:
+                getattr(self.client, method)(
+                    reverse('contact', kwargs={'id': user.id}), data,
+                    content_type="application/json")
+            self.assertEqual(counter.commits, 1)
+
+    @skipUnless(connection.vendor == 'postgresql',
+                'SQLite runs one writer at a time')
+    def test_parallel_writers_leave_no_partial_state(self):
+        self._create(self.client, "Owner", [], [])
+        owner = User.objects.get(firstname="Owner")
+        shared = ["shared%d@concurrent.test" % i for i in range(3)]
+        numbers = ["+9055500000%02d" % i for i in range(3)]
+        errors = []
+
+        def write(i):
+            client = Client()
+            try:
+                # the same new contacts, in different orders
+                order = 1 if i % 2 else -1
+                self._create(client, "Writer%d" % i,
+                             shared[::order] + ["own%d@concurrent.test" % i],
+                             numbers[::order])
+                response = client.post(
+                    reverse('contact', kwargs={'id': owner.id}),
+                    {"email": "added%d@concurrent.test" % i,
+                     "phone_number": "+9055511100%02d" % i},
+                    content_type="application/json")
+                self.assertEqual(response.status_code,
+                                 status.HTTP_201_CREATED)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [Thread(target=write, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Email.objects.filter(email__in=shared).count(), 3)
+        users = User.objects.filter(lastname="Concurrent")
+        self.assertEqual(users.count(), 9)
+        snapshots = contact_snapshots([user.id for user in users])
+        for user in users:
+            self.assertEqual(user.contacts, snapshots[user.id])
+        self.assertEqual(len(snapshots[owner.id]["emails"]), 8)
+        self.assertEqual(len(snapshots[owner.id]["phonenumbers"]), 8)
+
+    @skipUnless(connection.vendor == 'postgresql',
+                'SQLite runs one writer at a time')
+    def test_parallel_unlink_and_link_of_a_contact(self):
+        # the last user of a contact lets go of it while another links it
+        emails = ["gc%d@concurrent.test" % i for i in range(50)]
+        errors = []
+
+        def write(request):
+            try:
+                request(Client())
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        def unlink(client, user_id, method):
+            if method == 'put':
+                response = client.put(
+                    reverse('contact', kwargs={'id': user_id}),
+                    {"emails": [], "phonenumbers": []},
+                    content_type="application/json")
+            else:
+                response = client.delete(reverse('user'), {"id": user_id},
+                                         content_type="application/json")
+            self.assertEqual(response.status_code,
+                             status.HTTP_204_NO_CONTENT if method == 'delete'
+                             else status.HTTP_201_CREATED)
+
+        for attempt in range(10):
+            self._create(self.client, "Holder%d" % attempt, emails,
+                         ["+90555300%04d" % attempt])
+            holder = User.objects.get(firstname="Holder%d" % attempt)
+            threads = [
+                Thread(target=write, args=(lambda client: unlink(
+                    client, holder.id, ('put', 'delete')[attempt % 2]),)),
+                Thread(target=write, args=(lambda client: self._create(
+                    client, "Linker%d" % attempt, emails[::-1], []),)),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            linker = User.objects.get(firstname="Linker%d" % attempt)
+            self.assertEqual(linker.emails.count(), len(emails))
+            User.objects.filter(id=linker.id).delete()
+
+
+class UserDetailCacheTest(BaseAPITest):
+
+    def _detail(self):
+        return self.client.get(reverse('contact', kwargs={'id': 1}))
+
+    def test_cache_hits_and_misses(self):
+        before = stats()
+        self._detail()
+        with self.assertNumQueries(0):
+            self._detail()
+            self.client.get(reverse('email', kwargs={'id': 1, 'pk': 1}))
+            self.client.get(reverse('number', kwargs={'id': 1, 'pk': 1}))
+        after = self.client.get(reverse('cache-stats')).json()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 3)
+
+    def test_no_stale_read_after_write(self):
+        self._detail()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(reverse('contact', kwargs={'id': 1}),
+                            {"emails": ["new@mail.com"],
+                             "phonenumbers": ["+90 555"]},
+                            content_type="application/json")
+        detail = self._detail().json()
+        self.assertEqual(list(detail['emails'].values()), ["new@mail.com"])
+        self.assertEqual(list(detail['phonenumbers'].values()), ["+90555"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('contact', kwargs={'id': 1}),
+                             {"email": "more@mail.com",
+                              "phone_number": "+90 556"},
+                             content_type="application/json")
+        detail = self._detail().json()
+        self.assertIn("more@mail.com", detail['emails'].values())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('user'), {"id": 1},
+                               content_type="application/json")
+        self.assertEqual(self._detail().status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_no_stale_store_after_write(self):
+        def load_then_write():
+            # loaded before the write commits, stored after its invalidation
+            with self.captureOnCommitCallbacks(execute=True):
+                invalidate_users([1])
+            return {"stale": True}
+        self.assertEqual(get_user_detail(1, load_then_write), {"stale": True})
+        self.assertEqual(get_user_detail(1, lambda: {"fresh": True}),
+                         {"fresh": True})
+        self.assertEqual(get_user_details([1], lambda missing: {}),
+                         {1: {"fresh": True}})
+
+
+class AsyncReadEndpointTest(BaseAPITest):
+
+    def _assert_same(self, name, params=None, **kwargs):
+        expected = self.client.get(reverse(name, kwargs=kwargs), params)
+        response = self.client.get(reverse('async-' + name, kwargs=kwargs),
+                                   params)
+        self.assertEqual(response.status_code, expected.status_code)
+        if expected.status_code == status.HTTP_200_OK:
+            self.assertEqual(response.json(), expected.json())
+
+    def test_async_views_match_sync_views(self):
+        # an updated row moves to the end of the table on PostgreSQL
+        User.objects.filter(id=1).update(lastname="Moved")
+        self._assert_same('user')
+        self._assert_same('user', {'firstname': User.objects.get(
+            id=3).firstname})
+        self._assert_same('user', {'after': 3, 'limit': 2})
+        self._assert_same('user', {'limit': 'x'})
+        self._assert_same('contact', id=1)
+        self._assert_same('contact', {'fields': 'id,firstname'}, id=1)
+        self._assert_same('contact', {'fields': 'id', 'include': 'emails'},
+                          id=1)
+        self._assert_same('contact', {'fields': 'nope'}, id=1)
+        self._assert_same('contact', id=141)
+        self._assert_same('email', id=1, pk=1)
+        self._assert_same('email', id=1, pk=2)
+        self._assert_same('number', id=2, pk=2)
+
+    def test_async_views_are_read_only(self):
+        response = self.client.delete(reverse('async-user'))
+        self.assertEqual(response.status_code,
+                         status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@override_settings(MIDDLEWARE=['api.middleware.RequestMetricsMiddleware'])
+class RequestMetricsMiddlewareTest(BaseAPITest):
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as ctx, \
+                self.assertLogs('api.metrics') as logs:
+            response = self.client.get(reverse('user'))
+        timing = response['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('desc="%d queries"' % len(ctx.captured_queries),
+                      timing)
+        self.assertIn('ser;dur=', timing)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'user')
+        self.assertEqual(record['queries'], len(ctx.captured_queries))
+
+    def test_metrics_endpoint(self):
+        with self.assertLogs('api.metrics'):
+            self.client.get(reverse('contact', kwargs={'id': 1}))
+        body = metrics_view(RequestFactory().get('/metrics')).content.decode()
+        self.assertIn('api_request_duration_seconds_count{route="contact",'
+                      'method="GET",status="2xx"}', body)
+        self.assertIn('api_request_db_queries_total{route="contact",'
+                      'method="GET"}', body)
 
 
 class TestDetailedEmailContactView(BaseAPITest):
@@ -1,9 +1,23 @@
 from django.urls import path
-from .views import (UserView, ContactInfoView, DetailedEmailContactView,
-                    DetailedPhoneNumberContactView)
+from .views import (UserView, BulkUserView, UserExportView, UserChangesView,
+                    UserBatchView, UserLookupView, ContactInfoView,
+                    DetailedEmailContactView, DetailedPhoneNumberContactView,
+                    CacheStatsView, ImportJobView, ExportJobView, JobView,
+                    JobResultView)
 
 urlpatterns = [
     path('users/', UserView.as_view(), name='user'),
+    path('users/bulk/', BulkUserView.as_view(), name='bulk'),
+    path('users/export/', UserExportView.as_view(), name='export'),
+    path('users/changes/', UserChangesView.as_view(), name='changes'),
+    path('users/batch/', UserBatchView.as_view(), name='batch'),
+    path('users/jobs/import/', ImportJobView.as_view(), name='job-import'),
+    path('users/jobs/export/', ExportJobView.as_view(), name='job-export'),
+    path('users/jobs/<int:id>/', JobView.as_view(), name='job'),
+    path('users/jobs/<int:id>/result/', JobResultView.as_view(),
+         name='job-result'),
+    path('users/lookup/', UserLookupView.as_view(), name='lookup'),
+    path('users/cache/stats/', CacheStatsView.as_view(), name='cache-stats'),
     path('users/<int:id>/contact/', ContactInfoView.as_view(), name='contact'),
     path('users/<int:id>/contact/email/<int:pk>',
          DetailedEmailContactView.as_view(), name='email'),
@@ -1,23 +1,100 @@
+from collections import defaultdict
+from itertools import islice
+
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.urls import reverse
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 
-from .models import User, Email, PhoneNumber
+from .cache import (get_user_detail, get_user_details, invalidate_users,
+                    peek_user_detail, stats)
+from .conditional import (conditional_response, conditional_user_response,
+                          users_etag)
+from .jobs import submit_export, submit_import
+from .models import (User, Email, Job, PhoneNumber, UserChange, delete_users,
+                     load_user_detail, load_user_details, user_contact)
+from .normalization import normalize_email, normalize_phone
+from .pagination import (ChangeFeedPagination, KeysetPagination,
+                         RankedPagination)
+from .parsers import FastJSONParser, NDJSONParser
+from .renderers import dumps
+from .search import search_users
 from .serializers import (CreateUserWithContactInfoSerializer,
-                          ListUsersSerializer,
                           AddAdditionalContactInfoSerializer,
                           DetailedUserSerializer,
                           UpdateContactInfoSerializer,
                           DetailedEmailContactSerializer,
                           DetailedPhoneNumberContactSerializer,
-                          UserDeleteSerializer)
+                          UserDeleteSerializer,
+                          BulkUserDeleteSerializer,
+                          ExportJobSerializer,
+                          JobSerializer,
+                          UserBatchSerializer,
+                          UserLookupSerializer,
+                          UserSearchSerializer,
+                          requested_fields,
+                          serialize_user_rows,
+                          user_rows)
 
 from rest_framework.generics import GenericAPIView, ListAPIView
 
 
+def user_detail_entry(user_id):
+    """
+    The cached `{"user": <DetailedUserSerializer payload>, "updated_at": ..}`
+    of `user_id`, `None` if no such user.
+    """
+    def load():
+        user = load_user_detail(user_id)
+        if user is None:
+            return None
+        return {"user": dict(DetailedUserSerializer(user).data),
+                "updated_at": user.updated_at}
+    return get_user_detail(user_id, load)
+
+
+def user_detail_entries(user_ids):
+    """
+    The cached entries, as from `user_detail_entry`, of those of `user_ids`
+    that exist, keyed by id; the misses are loaded together in a constant
+    number of queries.
+    """
+    def load(missing):
+        return {user.id: {"user": dict(DetailedUserSerializer(user).data),
+                          "updated_at": user.updated_at}
+                for user in load_user_details(missing)}
+    return get_user_details(user_ids, load)
+
+
+def user_detail(user_id):
+    """The cached `DetailedUserSerializer` payload, `None` if no such user."""
+    entry = user_detail_entry(user_id)
+    return entry and entry["user"]
+
+
+def user_contact_detail(user_id, field_name, value_field, contact_id):
+    """
+    `(value, updated_at)` of contact `contact_id` of `User.<field_name>` of
+    user `user_id`, from the cached detail on a hit and else with a single
+    statement, which does not fill the cache; `None` if the user has no
+    such contact.
+    """
+    entry = peek_user_detail(user_id)
+    if entry is None:
+        return user_contact(field_name, value_field, user_id, contact_id)
+    value = entry["user"][field_name].get(contact_id)
+    return None if value is None else (value, entry["updated_at"])
+
+
 class UserView(GenericAPIView):
+    # id order, which the keyset pagination relies on
+    queryset = User.objects.order_by('id')
     filter_backends = [DjangoFilterBackend]
     filter_fields = ['id', 'firstname']
+    pagination_class = KeysetPagination
 
     def post(self, request):
         serializer = CreateUserWithContactInfoSerializer(data=request.data)
@@ -26,19 +103,248 @@ class UserView(GenericAPIView):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def get(self, request):
-        qs = self.filter_queryset(User.objects.all())
-        serializer = ListUsersSerializer(qs, many=True)
-        return Response(serializer.data)
+        fields = requested_fields(request.query_params)
+        if 'q' in request.query_params:
+            return self._search(request, fields)
+        qs = self.filter_queryset(self.get_queryset())
+        # validated against the rows the page is read from only
+        window = self.paginator.page_queryset(qs, request)
+        return conditional_response(
+            request, users_etag(qs if window is None else window), None,
+            lambda: self._list(qs, fields))
+
+    def _list(self, qs, fields):
+        page = self.paginate_queryset(user_rows(qs, fields))
+        if page is not None:
+            return self.get_paginated_response(
+                serialize_user_rows(page, fields=fields))
+        return Response(serialize_user_rows(list(user_rows(qs, fields)),
+                                            user_ids=qs.values('id'),
+                                            fields=fields))
+
+    def _search(self, request, fields):
+        serializer = UserSearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        qs = self.filter_queryset(search_users(serializer.validated_data['q']))
+        paginator = RankedPagination()
+        page = paginator.paginate_queryset(user_rows(qs, fields), request,
+                                           view=self)
+        return paginator.get_paginated_response(
+            serialize_user_rows(page, fields=fields))
 
     def delete(self, request):
         serializer = UserDeleteSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            user_ids, _ = delete_users(User.objects.filter(
+                id=serializer.validated_data['id']))
+            if not user_ids:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            invalidate_users(user_ids)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class BulkUserView(GenericAPIView):
+    parser_classes = [FastJSONParser, NDJSONParser]
+    filter_backends = [DjangoFilterBackend]
+    filter_fields = ['id', 'firstname', 'lastname']
+
+    def post(self, request):
+        # all-or-nothing: on failure `errors` has one entry per item, empty
+        # for the valid ones
+        serializer = CreateUserWithContactInfoSerializer(data=request.data,
+                                                         many=True)
+        if serializer.is_valid(raise_exception=True):
+            serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def delete(self, request):
+        # the users of `ids` in the body and/or those matching the filters
+        # of the query string; deleting everything takes an explicit filter
+        serializer = BulkUserDeleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        # django-filter ignores empty values, so they do not count either
+        filtered = {name for name, value in request.query_params.items()
+                    if value and name in self.filter_fields}
+        if 'ids' not in serializer.validated_data and not filtered:
+            raise ValidationError(
+                "Either ids or a filter on %s is required."
+                % ', '.join(self.filter_fields))
+        qs = self.filter_queryset(User.objects.all())
+        if 'ids' in serializer.validated_data:
+            qs = qs.filter(id__in=serializer.validated_data['ids'])
+        with transaction.atomic():
+            user_ids, counts = delete_users(qs)
+            invalidate_users(user_ids)
+        return Response(counts)
+
+
+class UserExportView(GenericAPIView):
+    filter_backends = [DjangoFilterBackend]
+    filter_fields = ['id', 'firstname']
+    chunk_size = 2000
+
+    def get(self, request):
+        fields = requested_fields(request.query_params)
+        qs = self.filter_queryset(User.objects.order_by('id'))
+        rows = user_rows(qs, fields).iterator(chunk_size=self.chunk_size)
+        return StreamingHttpResponse(self._stream(rows, fields),
+                                     content_type='application/x-ndjson')
+
+    def _stream(self, rows, fields):
+        # one user per line; contacts are batch-loaded per chunk so memory
+        # stays bounded by chunk_size whatever the size of the table
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            yield b''.join(dumps(user) + b'\n'
+                           for user in serialize_user_rows(chunk,
+                                                           fields=fields))
+
+
+class UserChangesView(GenericAPIView):
+    pagination_class = ChangeFeedPagination
+
+    def get(self, request):
+        # the latest change of each user in the page, in cursor order, with
+        # its current state (`null` once deleted)
+        latest = {}
+        for change in self.paginate_queryset(UserChange.objects.all()):
+            latest.pop(change.user_id, None)
+            latest[change.user_id] = change
+        alive = [user_id for user_id, change in latest.items()
+                 if change.kind != UserChange.DELETED]
+        users = {row['id']: row for row in serialize_user_rows(
+            list(user_rows(User.objects.filter(id__in=alive))))}
+        return self.get_paginated_response([
+            {"cursor": change.id, "id": user_id, "change": change.kind,
+             "user": users.get(user_id)}
+            for user_id, change in latest.items()])
+
+
+class UserBatchView(GenericAPIView):
+
+    def get(self, request):
+        return self._batch(request, {"ids": [
+            value for param in request.query_params.getlist("ids")
+            for value in param.split(",") if value]})
+
+    def post(self, request):
+        return self._batch(request, request.data)
+
+    def _batch(self, request, data):
+        fields = requested_fields(request.query_params)
+        serializer = UserBatchSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        # request order, each id once
+        ids = list(dict.fromkeys(serializer.validated_data["ids"]))
+        entries = user_detail_entries(ids)
+        return Response({
+            "results": [{key: value
+                         for key, value in entries[user_id]["user"].items()
+                         if key in fields}
+                        for user_id in ids if user_id in entries],
+            "missing": [user_id for user_id in ids if user_id not in entries],
+        })
+
+
+def job_accepted(job):
+    """202 with the status of the just submitted `job`, polled at Location."""
+    return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED,
+                    headers={'Location': reverse('job',
+                                                 kwargs={'id': job.id})})
+
+
+class ImportJobView(GenericAPIView):
+    parser_classes = [FastJSONParser, NDJSONParser]
+
+    def post(self, request):
+        # the rows are validated by the workers, invalid ones are reported
+        # in the job's `errors` without failing the others
+        if not isinstance(request.data, list):
+            raise ValidationError("Expected a list of users.")
+        return job_accepted(submit_import(request.data))
+
+
+class ExportJobView(GenericAPIView):
+
+    def post(self, request):
+        fields = requested_fields(request.query_params)
+        serializer = ExportJobSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return job_accepted(submit_export(dict(serializer.validated_data),
+                                          fields))
+
+
+class JobView(GenericAPIView):
+
+    def get(self, request, **kwargs):
         try:
-            user = User.objects.get(id=serializer.validated_data['id'])
-            user.delete()
-        except User.DoesNotExist:
+            job = Job.objects.get(id=kwargs['id'])
+        except Job.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(JobSerializer(job).data)
+
+
+class JobResultView(GenericAPIView):
+
+    def get(self, request, **kwargs):
+        try:
+            job = Job.objects.get(id=kwargs['id'], kind=Job.EXPORT)
+        except Job.DoesNotExist:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        if job.status != Job.DONE:
+            return Response(JobSerializer(job).data,
+                            status=status.HTTP_409_CONFLICT)
+        # the NDJSON of each partition in turn, one in memory at a time
+        outputs = job.parts.order_by('number').values_list(
+            'output', flat=True).iterator(chunk_size=1)
+        return StreamingHttpResponse((output.encode() for output in outputs),
+                                     content_type='application/x-ndjson')
+
+
+class UserLookupView(GenericAPIView):
+
+    def get(self, request):
+        return self._lookup({
+            "emails": request.query_params.getlist("email"),
+            "phonenumbers": request.query_params.getlist("phone"),
+        })
+
+    def post(self, request):
+        return self._lookup(request.data)
+
+    def _lookup(self, data):
+        serializer = UserLookupSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        return Response({
+            "emails": self._owners(
+                serializer.validated_data.get("emails", []), "emails",
+                "email", normalize_email),
+            "phonenumbers": self._owners(
+                serializer.validated_data.get("phonenumbers", []),
+                "phonenumbers", "number", normalize_phone),
+        })
+
+    def _owners(self, values, field_name, value_field, normalize):
+        """
+        Map each of `values` to the ids of the users it belongs to, with a
+        single query over the unique index of the (normalized) contact
+        values.
+        """
+        if not values:
+            return {}
+        field = User._meta.get_field(field_name)
+        target = field.m2m_reverse_field_name()
+        keys = {value: normalize(value) for value in values}
+        rows = field.remote_field.through.objects.filter(**{
+            target + '__' + value_field + '__in': set(keys.values()),
+        }).values_list(target + '__' + value_field, 'user_id')
+        owners = defaultdict(list)
+        for key, user_id in rows:
+            owners[key].append(user_id)
+        return {value: sorted(owners[key]) for value, key in keys.items()}
 
 
 class ContactInfoView(GenericAPIView):
@@ -55,12 +361,15 @@ class ContactInfoView(GenericAPIView):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def get(self, request, **kwargs):
-        try:
-            qs = User.objects.get(id=kwargs['id'])
-        except User.DoesNotExist:
+        # the whole payload is cached, `fields` only trims the response
+        fields = requested_fields(request.query_params)
+        entry = user_detail_entry(kwargs['id'])
+        if entry is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        serializer = DetailedUserSerializer(qs)
-        return Response(serializer.data)
+        return conditional_user_response(
+            request, kwargs['id'], entry["updated_at"], lambda: Response(
+                {key: value for key, value in entry["user"].items()
+                 if key in fields}))
 
     def put(self, request, **kwargs):
         try:
@@ -80,16 +389,13 @@ class DetailedEmailContactView(ListAPIView):
     queryset = Email.objects.all()
 
     def list(self, request, *args, **kwargs):
-        try:
-            qs = User.objects.get(id=kwargs['id'])
-        except User.DoesNotExist:
-            return Response(status=status.HTTP_404_NOT_FOUND)
-        try:
-            email = qs.emails.get(pk=kwargs['pk'])
-        except Email.DoesNotExist:
+        contact = user_contact_detail(kwargs['id'], "emails", "email",
+                                      kwargs['pk'])
+        if contact is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        serializer = self.serializer_class(email)
-        return Response(serializer.data)
+        value, updated_at = contact
+        return conditional_user_response(request, kwargs['id'], updated_at,
+                                         lambda: Response({"email": value}))
 
 
 class DetailedPhoneNumberContactView(ListAPIView):
@@ -97,13 +403,16 @@ class DetailedPhoneNumberContactView(ListAPIView):
     queryset = PhoneNumber.objects.all()
 
     def list(self, request, *args, **kwargs):
-        try:
-            qs = User.objects.get(id=kwargs['id'])
-        except User.DoesNotExist:
+        contact = user_contact_detail(kwargs['id'], "phonenumbers", "number",
+                                      kwargs['pk'])
+        if contact is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        try:
-            email = qs.phonenumbers.get(pk=kwargs['pk'])
-        except PhoneNumber.DoesNotExist:
-            return Response(status=status.HTTP_404_NOT_FOUND)
-        serializer = self.serializer_class(email)
-        return Response(serializer.data)
+        value, updated_at = contact
+        return conditional_user_response(request, kwargs['id'], updated_at,
+                                         lambda: Response({"number": value}))
+
+
+class CacheStatsView(GenericAPIView):
+
+    def get(self, request):
+        return Response(stats())
@@ -0,0 +1,18 @@
+"""
+Gunicorn configuration for serving users.wsgi in production:
+
+    gunicorn -c gunicorn.conf.py users.wsgi:application
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS',
+                             multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+max_requests = 10000
+max_requests_jitter = 1000
+accesslog = '-'
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -52,6 +53,24 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Per-request query/timing instrumentation with Server-Timing headers, JSON
+# logs on the api.metrics logger and a Prometheus endpoint at /metrics
+REQUEST_METRICS = bool(os.environ.get('REQUEST_METRICS'))
+
+if REQUEST_METRICS:
+    MIDDLEWARE.insert(0, 'api.middleware.RequestMetricsMiddleware')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.metrics': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
 ROOT_URLCONF = 'users.urls'
 
 TEMPLATES = [
@@ -73,7 +92,16 @@ TEMPLATES = [
 WSGI_APPLICATION = 'users.wsgi.application'
 
 REST_FRAMEWORK = {
-    'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend']
+    'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 # Database
@@ -91,6 +119,52 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+if os.environ.get('REDIS_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+    }
+
+# Cache alias and timeout (seconds) of the per-user detail payloads
+USER_CACHE_ALIAS = 'default'
+USER_CACHE_TIMEOUT = 300
+
+# Serialize user reads from the denormalized User.contacts column instead of
+# joining the contact tables. Run `manage.py backfill_contact_snapshots`
+# before turning it on.
+USER_CONTACT_SNAPSHOT_READS = False
+
+# Maximum number of concurrent ORM calls (hence database connections) per
+# event loop made by the async views in api/async_views.py
+ASYNC_DB_POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', 10))
+
+# How long (seconds) the change feed waits for a missing cursor value to be
+# committed before taking it for a rolled back write
+USER_CHANGES_SETTLE_SECONDS = 5
+
+# Maximum number of users taken from each of the names, emails and phone
+# numbers when collecting the matches of a `?q=` search, before ranking
+SEARCH_MAX_CANDIDATES = 1000
+
+# Background jobs (api/jobs.py): rows per import partition, span of user ids
+# per export partition, how long (seconds) a worker's claim on a partition
+# lasts before another worker may run it again, and how many times a
+# partition is tried before its job fails
+JOB_IMPORT_PARTITION_SIZE = 1000
+JOB_EXPORT_PARTITION_SIZE = 10000
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -0,0 +1,34 @@
+"""
+Production settings for users project.
+
+Select with DJANGO_SETTINGS_MODULE=users.settings_production. Everything
+deployment specific comes from the environment.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+DEBUG = False
+
+SECRET_KEY = os.environ['DJANGO_SECRET_KEY']
+
+ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', '0.0.0.0').split(',')
+
+DATABASES['default'].update({
+    'NAME': os.environ.get('POSTGRES_DB', 'users'),
+    'HOST': os.environ.get('POSTGRES_HOST', 'postgres'),
+    'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+    'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+    'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'postgres'),
+    # keep connections open across requests instead of reconnecting on
+    # every request, and ping them before reuse (see api/db.py)
+    'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 60)),
+    'CONN_HEALTH_CHECKS': True,
+})
+
+if os.environ.get('POSTGRES_POOLER'):
+    # transaction pooling (PgBouncer) can hand each statement of a request
+    # to another server connection, so named cursors can't be used
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True